@@ -1,59 +1,170 @@
 import asyncio
 import json
+import logging
 import math
 import os
 import socket
-from concurrent.futures import ThreadPoolExecutor
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from urllib.parse import urlparse
 
-import aiohttp
 from aiohttp import web
 import websockets
 import numpy as np
 
+import audio_codec
+from assets import AssetCache
+from broadcast import CoalescedBroadcaster, UserListChanges
+from cache import SingleFlightCache
+from container import ListenerStreams, SpeakerStreams
+from dsp import GainProcessor, TierTranscoder, quantize_gain
+from ingest import PositionIngest
+from metrics import FANOUT_BUCKETS, Metrics, SampledLogger
+from framing import audio_frame
+from mixer import AudioMixer
+from outbound import OutboundQueue
+from protocol import BINARY_SUBPROTOCOL, is_audio_chunk, is_control_message, is_valid_position, parse_dimension, unpack_position, user_list_messages
+from scheduler import MotionTracker, Ticker
+from position_store import PositionStore
+from ratelimit import ConnectionLimiter
+from recorder import SOURCE_CLIENT, SOURCE_INGEST, SOURCE_POLL, SessionRecorder
+from upstream import CircuitOpenError, UpstreamClient
+from vad import MODES as VAD_MODES, VoiceActivityGate, energy_available
+
 HTTP_PORT = 19133
 WS_PORT = 19134
 API_BASE_URL = "http://localhost:5000/api/get"  # 外部APIサーバー 要書き換え
-
-user_positions = []
+HEARING_DISTANCE = 30  # 声が届く距離 (ブロック)
+UPSTREAM_MAX_CONNECTIONS = 32  # APIサーバーへの同時接続数の上限
+UPSTREAM_TIMEOUT = 3.0  # APIサーバーへのリクエストのタイムアウト (秒)
+UPSTREAM_FAILURE_THRESHOLD = 5  # この回数連続で失敗したら問い合わせを止める
+UPSTREAM_RESET_TIMEOUT = 10.0  # 問い合わせを止めてから再試行するまでの時間 (秒)
+PLAYER_LIST_INTERVAL = 5.0  # プレイヤーリストを取得する間隔 (秒)
+PLAYER_LIST_CACHE_TTL = 2.0  # 取得したプレイヤーリストを /playerList や接続時に使い回す秒数
+POSITION_TICK_INTERVAL = 0.1  # 問い合わせる座標の確認と推定座標の更新を行う間隔 (秒)
+POSITION_POLL_MIN_INTERVAL = 0.25  # 速く動いているユーザーの座標を取得する間隔 (秒)
+POSITION_POLL_MAX_INTERVAL = 5.0  # 止まっているユーザーの座標を取得する間隔 (秒)
+POSITION_POLL_STEP = 2.0  # 座標を取得する間にユーザーが動く距離の目安 (ブロック)。速さからこの距離で間隔を決める
+POSITION_POLL_INTERVAL = 1.0  # 座標を取得できなかったユーザーを再び問い合わせるまでの間隔 (秒)
+POSITION_EXTRAPOLATION_HORIZON = 1.0  # 最後に取得した座標から速度で推定する時間の上限 (秒)
+POSITION_FETCH_CONCURRENCY = 16  # 座標を同時に問い合わせるユーザー数の上限
+BULK_POSITION_POLLING = False  # True にすると WorldPlayer を1回だけ呼んで全員の座標をまとめて取得する
+POSITION_DRIFT_WARNING = 0.5  # update_positions の周期がこの秒数以上遅れたらログに出す
+USER_LIST_BROADCAST_WINDOW = 0.1  # この秒数の間に来た userList の送信要求を1回にまとめる
+USER_LIST_DISTANCE_THRESHOLD = 0.5  # 距離がこれ以上変わったら userList を送り直す (ブロック)
+USER_LIST_VOLUME_THRESHOLD = 0.02  # 音量がこれ以上変わったら userList を送り直す
+MAX_QUEUED_AUDIO_FRAMES = 8  # 受信者ごとに溜めておく音声フレーム数の上限 (超えたら古いものから捨てる)
+WS_WRITE_LIMIT = 256 * 1024  # 接続ごとの書き込みバッファの上限 (バイト)
+WS_MAX_MESSAGE_BYTES = 256 * 1024  # これより大きいメッセージを送った接続は websockets が 1009 で閉じる
+MAX_CONNECTIONS = 1000  # 同時接続数の上限 (超えた接続は 1013 で閉じる)
+MAX_AUDIO_FRAME_BYTES = 64 * 1024  # 音声1メッセージの大きさの上限 (超えたものは解析だけして配らない)
+RATE_LIMITS = {"position": (20.0, 40), "audio": (20.0, 40), "other": (2.0, 10)}  # メッセージの種類ごとの (回/秒, バースト)
+RECORD_PATH = None  # ファイル名を設定すると接続・座標・音声をそのファイルに追記で記録する (bench/replay.py で再生できる)
+RECORD_AUDIO_PAYLOADS = False  # True にすると音声の中身も記録する (False なら大きさだけ)
+RECORD_MAX_BYTES = 1024 * 1024 * 1024  # 記録ファイルに1回の起動で書く量の上限 (バイト)
+RATE_LIMIT_VIOLATIONS = (5.0, 100)  # 制限を超えたメッセージの (回/秒, バースト)。これも超えて送り続ける接続は 1008 で切断する
+LOG_LEVEL = "INFO"  # "DEBUG" にすると音声フレームごとのログ (間引きあり) も出る
+LOG_SAMPLE_EVERY = 100  # 頻繁に出るログは同じ種類ごとにこの件数に1件だけ出す
+VAD_MODE = "size"  # 声の入っていない音声を中継前に捨てる方法 ("off" / "size" / "energy")。energy は PyAV が必要
+VAD_USER_MODES = {}  # ユーザーごとに VAD_MODE を変える場合 (username -> モード)
+VAD_HANGOVER = 2  # 声が途切れてからも中継を続けるチャンク数 (クライアントは 500ms ごとに送るので、1チャンク分 + 揺らぎ)
+VAD_SIZE_RATIO = 1.5  # size: 無音時のチャンクの大きさの何倍を超えたら声とみなすか
+VAD_ENERGY_THRESHOLD = -45.0  # energy: この音量 (dBFS) を超えたら声とみなす
+INGEST_STALE_AFTER = 3.0  # /ingest からこの秒数なにも届かなければポーリングに戻す
+# 環境変数 VC_INGEST_TOKEN を設定すると /ingest に "Authorization: Bearer <token>" を要求する (未設定なら同じマシンからの接続だけを受け付ける)
+# このファイルは配信されうるので、トークンをここに書かないこと
+INGEST_TOKEN = os.environ.get("VC_INGEST_TOKEN") or None
+# 音声の中継方法
+#   "forward": 話者の音声は変更せず、送信者IDと音量をヘッダーに付けて転送する (音量は再生側で掛ける)
+#   "volume": 受信者ごとに音量を調整して話者の音声をそのまま転送する
+#   "mix": サーバーでデコードし、受信者ごとに近くの話者の音声を混ぜて1本にして送る (PyAV が必要)
+#   "tiered": forward と同じだが、遠くの受信者には低いビットレートでエンコードし直した音声を送る (PyAV が必要)
+AUDIO_RELAY_MODE = "forward"
+# tiered: 受信者までの距離 (ブロック) の上限とその段のビットレート。None の段は話者の音声をそのまま転送する
+BITRATE_TIERS = [(8, None), (18, 24000), (HEARING_DISTANCE, 12000)]
+AUDIO_MIX_INTERVAL = 0.5  # ミックスした音声を送る間隔 (秒)
+AUDIO_MIX_BITRATE = 64000  # ミックスした音声のビットレート
+AUDIO_VOLUME_BITRATE = 64000  # volume: 音量を調整してエンコードし直した音声のビットレート
+GAIN_BUCKET_DB = 3.0  # volume / mix: 音量をこの幅 (dB) に丸め、同じ音量になる受信者には同じ処理結果を送る
+DSP_EXECUTOR = "thread"  # 音声のデコード・エンコードを行う場所 ("thread" / "process")。process ならイベントループと GIL を取り合わない
+DSP_WORKERS = None  # そのワーカー数 (None なら CPU の数に合わせる)
+
+user_positions = {}  # username -> {"username", "position", "dimension"}
 cached_player_list = []
+cached_player_uuids = {}  # username -> uniqueId (まとめて取得した座標の振り分けに使う)
 websocket_server = None
 loop = None
-executor = ThreadPoolExecutor()
+executor = None  # 音声のデコード・エンコードを行う executor (main で作る)
+audio_mixer = None  # mix で使う (main で作る)
+gain_processor = None  # volume で使う (main で作る)
+tier_transcoder = None  # tiered で使う (main で作る)
 connected_websockets = set()  # 接続中の WebSocket を追跡するセット
+logger = logging.getLogger("vcSystem")
+sampled_log = SampledLogger(logger, LOG_SAMPLE_EVERY)
+metrics = Metrics()  # /metrics で公開する計測値
+asset_cache = AssetCache(os.path.dirname(os.path.abspath(__file__)))  # send_file で返す静的ファイル
+upstream = UpstreamClient(
+    API_BASE_URL,
+    max_connections=UPSTREAM_MAX_CONNECTIONS,
+    timeout=UPSTREAM_TIMEOUT,
+    failure_threshold=UPSTREAM_FAILURE_THRESHOLD,
+    reset_timeout=UPSTREAM_RESET_TIMEOUT,
+    latency_histogram=metrics.histogram("vc_upstream_latency_seconds"),
+)
+sockets_by_username = {}  # username -> WebSocket
+speaker_streams = SpeakerStreams()  # 話者ごとの WebM の解析状態 (初期化セグメントを覚えておく)
+ingest = None  # ゲーム側から座標を受け取る /ingest (main で作る)
+motion = None  # ユーザーごとの速度と次に座標を問い合わせる時刻 (main で作る)
+voice_gate = None  # 無音の音声を捨てる VoiceActivityGate (main で作る)
+player_list_cache = None  # プレイヤーリストの SingleFlightCache (main で作る)
+recorder = None  # RECORD_PATH を設定したときの SessionRecorder (main で作る)
+next_session_id = 0  # 音声ヘッダーで送信者を表す番号 (接続ごとに割り当てる)
 
 async def fetch_data(endpoint, options=None):
-    url = f"{API_BASE_URL}/{endpoint}"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers=options) as response:
-                if response.status != 200:
-                    try:
-                        error_data = await response.json()
-                    except:
-                        error_data = {"error": "Failed to parse error response."}
-                    raise Exception(f"HTTP error {response.status} fetching {url}: {json.dumps(error_data)}")
-                return await response.json()
+        return await upstream.get_json(endpoint, headers=options)
+    except CircuitOpenError:
+        # API サーバーが応答しない間は問い合わせずにすぐ諦める
+        return None
     except Exception as error:
-        print(f"Error fetching {url}:", error)
+        sampled_log.warning("fetch:" + endpoint.split("?")[0], "Error fetching %s/%s: %s", API_BASE_URL, endpoint, error)
         return None
 
 async def get_player_data(player_name):
     return await fetch_data(f"WorldPlayer?playerName={player_name}")
 
-async def get_player_list():
-    global cached_player_list
+async def fetch_player_list():
+    """API サーバーからプレイヤーリストを取得します。取得できなければ None を返します (player_list_cache から呼ばれる)。"""
+    global cached_player_list, cached_player_uuids
     player_list = await fetch_data("playerList")
-    if player_list:
-        cached_player_list = [player["name"] for player in player_list]
+    if not isinstance(player_list, list):
+        return None
+    cached_player_list = [player["name"] for player in player_list]
+    cached_player_uuids = {player["name"]: player.get("uuid") for player in player_list}
     return cached_player_list
 
-def get_volume_by_distance(distance, max_distance=30, max_volume=1.0, min_volume=0.01):
+async def get_player_list():
+    """
+    プレイヤーリストを返します。PLAYER_LIST_CACHE_TTL 秒以内に取得したものがあればそれを使い、
+    同時に呼ばれても API サーバーへの問い合わせは1回にまとめます。取得に失敗したら最後に取得できたものを返します。
+    """
+    player_list = await player_list_cache.get()
+    return cached_player_list if player_list is None else player_list
+
+def get_volume_by_distance(distance, max_distance=HEARING_DISTANCE, max_volume=1.0, min_volume=0.01):
     if distance > max_distance:
         return min_volume
     volume = max_volume / (1 + math.pow(distance, 2))
     return max(volume, min_volume)
 
+def get_volume_by_distance_array(distances, max_distance=HEARING_DISTANCE, max_volume=1.0, min_volume=0.01):
+    # get_volume_by_distance を距離の配列に対してまとめて計算する版
+    volume = np.maximum(max_volume / (1 + np.power(distances, 2)), min_volume)
+    return np.where(distances > max_distance, min_volume, volume)
+
+# 近接検索のインデックス。音量 (最大音量 0.5) は nearby() のたびに、グリッドで絞った相手の分だけ NumPy でまとめて計算する
+position_index = PositionStore(HEARING_DISTANCE, lambda distances: get_volume_by_distance_array(distances, max_volume=0.5))
+
 def calculate_distance(user1_pos, user2_pos):
     return math.sqrt(
         (user1_pos["x"] - user2_pos["x"]) ** 2 +
@@ -61,21 +172,38 @@ def calculate_distance(user1_pos, user2_pos):
         (user1_pos["z"] - user2_pos["z"]) ** 2
     )
 
-def get_nearby_users(current_user):
-    global user_positions
-    current_user_position = next((u["position"] for u in user_positions if u["username"] == current_user), None)
-    if not current_user_position:
-        return []
+def set_user_position(username, position, dimension=None, source=SOURCE_CLIENT):
+    user = user_positions.get(username)
+    if user is None or not is_valid_position(position):
+        return False
+    if recorder is not None:
+        recorder.position(username, position, dimension, source)
+    user["position"] = {"x": position["x"], "y": position["y"], "z": position["z"]}
+    if dimension is not None:
+        user["dimension"] = dimension
+    position_index.update(username, user["position"], user["dimension"])
+    if motion is not None:
+        motion.record(username, user["position"], user["dimension"])
+    return True
 
+def get_nearby_users(current_user):
     return [
         {
-            "username": u["username"],
-            "distance": calculate_distance(current_user_position, u["position"])
+            "username": username,
+            "id": user_positions[username]["id"],
+            "distance": distance
         }
-        for u in user_positions
-        if u["username"] != current_user and calculate_distance(current_user_position, u["position"]) <= 30
+        for username, distance, _ in position_index.nearby(current_user)
     ]
 
+def allocate_session_id():
+    global next_session_id
+    in_use = {u["id"] for u in user_positions.values()}
+    while True:
+        next_session_id = next_session_id % 0xFFFF + 1
+        if next_session_id not in in_use:
+            return next_session_id
+
 async def send_player_list(request):
     try:
         player_list = await get_player_list()
@@ -84,18 +212,14 @@ async def send_player_list(request):
         print("プレイヤーリストの取得に失敗しました:", error)
         return web.json_response({"message": "Internal Server Error"}, status=500)
 
+async def send_upstream_stats(request):
+    return web.json_response(upstream.snapshot())
+
 async def send_file(request):
     filename = request.match_info.get('filename', 'index.html')
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-
-    try:
-      with open(filepath, 'rb') as f:
-          return web.Response(body=f.read(), content_type="text/html")
-    except FileNotFoundError:
-        return web.Response(text="File not found", status=404)
+    return asset_cache.response(request, filename)
 
 async def handle_websocket(websocket):
-    global user_positions, connected_websockets
     # 'Origin' ヘッダーと path を組み合わせて URL を再構築
     origin = websocket.request.headers.get('Origin', '')  # request 経由で headers にアクセス
     path = websocket.request.path
@@ -103,128 +227,322 @@ async def handle_websocket(websocket):
     username = parsed_url.query.split("username=")[1] if "username=" in parsed_url.query else None
 
     if not username:
+        metrics.inc("vc_connections_rejected_total", reason="no_username")
         await websocket.close(code=1008, reason="Username is required")
         return
 
+    if len(connected_websockets) >= MAX_CONNECTIONS:
+        metrics.inc("vc_connections_rejected_total", reason="full")
+        await websocket.close(code=1013, reason="Server is full")
+        return
+
+    # すでに接続されているユーザーか確認
+    if username in user_positions:
+        metrics.inc("vc_connections_rejected_total", reason="duplicate")
+        await websocket.close(code=1008, reason="Username already connected")
+        return
+
     websocket.username = username
 
-    user_positions.append({"username": username, "position": {"x": 0, "y": 0, "z": 0}})
+    user_positions[username] = {"username": username, "id": allocate_session_id(), "position": {"x": 0, "y": 0, "z": 0}, "dimension": 0}
+    position_index.update(username, user_positions[username]["position"])
+    # "vc.bin.v1" を選んだクライアントには setPosition / userList を固定長のバイナリで送る
+    websocket.binary_protocol = websocket.subprotocol == BINARY_SUBPROTOCOL
+    websocket.sent_names = {}  # ID -> この接続に伝えたユーザー名
+    # "vc.bin.v1" のクライアントには話者ごとに初期化セグメントを1回だけ送り、その後はクラスターとブロックだけを送る
+    websocket.streams = ListenerStreams() if websocket.binary_protocol else None
+    websocket.vad_mode = VAD_USER_MODES.get(username, VAD_MODE)
+    websocket.limiter = ConnectionLimiter(RATE_LIMITS, RATE_LIMIT_VIOLATIONS)
 
     print(f"{username} が接続しました")
+    if recorder is not None:
+        recorder.connect(username, websocket.binary_protocol)
 
-    await websocket.send(json.dumps({"type": "playerList", "players": cached_player_list}))
+    websocket.outbound = OutboundQueue(websocket, MAX_QUEUED_AUDIO_FRAMES)
+    websocket.outbound.start()
 
-    await broadcast_user_list()
-    
+    # 上限の確認からここまでは await しないので、登録した時点で枠が確保される
+    # (プレイヤー一覧の取得を待つ間に来た接続が上限を素通りしないよう、取得は登録の後で行う)
     connected_websockets.add(websocket)
+    sockets_by_username[username] = websocket
+    user_list_broadcaster.request()
 
     try:
+        websocket.outbound.send(json.dumps({"type": "playerList", "players": await get_player_list()}))
         async for message in websocket:
+            if websocket.limiter.exceeded:
+                # 制限を超えたメッセージを送り続ける接続は切断する
+                metrics.inc("vc_connections_rejected_total", reason="rate_limit")
+                print(f"{username} は送信が多すぎるため切断します")
+                await websocket.close(code=1008, reason="Rate limit exceeded")
+                break
             if isinstance(message, websockets.Data):
                 try:
                     if isinstance(message, str):
                         data = json.loads(message)
+                        if not admit_message(websocket, "position" if data["type"] == "setPosition" else "other"):
+                            continue
                         if data["type"] == "setPosition":
                             position = data["position"]
-                            if (
-                                position and
-                                isinstance(position["x"], (int, float)) and
-                                isinstance(position["y"], (int, float)) and
-                                isinstance(position["z"], (int, float))
-                            ):
-                                user_index = next((i for i, u in enumerate(user_positions) if u["username"] == username), -1)
-                                if user_index != -1:
-                                    user_positions[user_index]["position"] = position
-                                    await broadcast_user_list()
+                            if is_valid_position(position):
+                                dimension = parse_dimension(data.get("dimension"))
+                                if set_user_position(username, position, dimension):
+                                    user_list_broadcaster.request()
                             else:
-                                print(f"Invalid position data received from {username}:", position)
+                                sampled_log.warning("invalid-position", "Invalid position data received from %s: %s", username, position)
+                        elif data["type"] == "setVoiceGate":
+                            # クライアントから自分の音声の判定方法を変える ("off" で常に中継)
+                            if data.get("mode") in VAD_MODES:
+                                websocket.vad_mode = data["mode"]
+                        metrics.inc("vc_messages_received_total", rate=True, type=data["type"] if data["type"] == "setPosition" else "other")
+                        continue
+
+                    if is_control_message(message) and not is_audio_chunk(message):
+                        # バイナリの setPosition (音声の先頭バイトとは重ならない)
+                        if not admit_message(websocket, "position"):
+                            continue
+                        decoded = unpack_position(message)
+                        if decoded is None:
+                            sampled_log.warning("invalid-position", "Invalid binary position received from %s: %r", username, message[:16])
+                        elif set_user_position(username, *decoded):
+                            user_list_broadcaster.request()
+                        metrics.inc("vc_messages_received_total", rate=True, type="setPosition")
+                        continue
+
+                    metrics.inc("vc_messages_received_total", rate=True, type="audio")
+                    if recorder is not None:
+                        recorder.audio(username, message)
+                    if is_audio_chunk(message):
+                        message = message[1:]  # 録音中のストリームの続き
+                    # 捨てるチャンクも解析器には通し、ストリームの続きを読めるようにしておく
+                    chunk = speaker_streams.push(username, message)
+                    # 送りすぎた分は解析だけして配らない (解析を飛ばすとストリームの続きが読めなくなる)
+                    # 大きすぎるフレームも送信回数には数え、送り続ける接続は制限・切断の対象にする
+                    if not admit_message(websocket, "audio"):
+                        continue
+                    if len(message) > MAX_AUDIO_FRAME_BYTES:
+                        metrics.inc("vc_audio_frames_oversized_total")
+                        sampled_log.warning("oversized", "Dropped an oversized audio frame (%d bytes) from %s", len(message), username)
+                        continue
+                    # 声の入っていないチャンクは受信者に配らない
+                    if not await voice_gate.allow(
+                        username, message, websocket.vad_mode, parsed=chunk,
+                        # vc.bin.v1 でないクライアントは自分で無音を捨ててから送る
+                        pre_gated=not websocket.binary_protocol,
+                    ):
+                        continue
+                    if chunk is not None and not chunk.media:
+                        continue  # 初期化セグメントだけのチャンク (受信者には次のブロックと一緒に送る)
+                    if AUDIO_RELAY_MODE == "forward":
+                        forward_audio_data(username, message, chunk)
+                    elif AUDIO_RELAY_MODE == "tiered":
+                        await relay_tiered_audio(username, message, chunk)
+                    elif AUDIO_RELAY_MODE == "mix":
+                        # 音声データは mix_audio でまとめて送る (デコードできるよう初期化セグメントを付ける)
+                        audio_mixer.push(username, message if chunk is None else chunk.standalone())
                     else:
                         # 音声データを送信元以外の近接ユーザーにのみブロードキャスト
-                        await broadcast_audio_data(username, message)
+                        await broadcast_audio_data(username, message if chunk is None else chunk.standalone())
                 except json.JSONDecodeError:
-                    print("Failed to parse message")
+                    sampled_log.warning("parse", "Failed to parse message from %s", username)
             else:
                 print(f"Unsupported message type received from {username}:", type(message))
 
-    except websockets.exceptions.ConnectionClosed:
-        pass
+    except websockets.exceptions.ConnectionClosed as error:
+        if error.sent is not None and error.sent.code == 1009:
+            # WS_MAX_MESSAGE_BYTES を超えるメッセージを送ってきた
+            metrics.inc("vc_connections_rejected_total", reason="message_too_large")
     finally:
         print(f"{username} が切断しました")
-        user_positions = [u for u in user_positions if u["username"] != username]
+        if recorder is not None:
+            recorder.disconnect(username)
+        user_positions.pop(username, None)
+        position_index.remove(username)
+        motion.forget(username)
+        voice_gate.forget(username)
+        speaker_streams.forget(username)
         connected_websockets.remove(websocket)
-        await broadcast_user_list()
+        sockets_by_username.pop(username, None)
+        user_list_changes.forget(websocket)
+        user_list_broadcaster.request()
+        await websocket.outbound.close()
+        if websocket.outbound.dropped_frames:
+            print(f"{username} への音声フレームを {websocket.outbound.dropped_frames} 個破棄しました")
 
 async def broadcast_user_list():
-    for ws in connected_websockets:
+    started = time.perf_counter()
+    sent = 0
+    for ws in list(connected_websockets):
         if hasattr(ws, 'username'):
             nearby_users = get_nearby_users(ws.username)
-            try:
-                await ws.send(json.dumps({"type": "userList", "users": nearby_users}))
-            except Exception as e:
-                print(f"Error sending user list to {ws.username}: {e}")
+            if not user_list_changes.changed(ws, nearby_users):
+                continue
+            if ws.binary_protocol:
+                *names, user_list = user_list_messages(nearby_users, ws.sent_names)
+                for message in names:
+                    ws.outbound.send(message)
+                ws.outbound.send_user_list(user_list)
+            else:
+                ws.outbound.send_user_list(json.dumps({"type": "userList", "users": nearby_users}))
+            sent += 1
+    metrics.inc("vc_user_list_sent_total", sent)
+    metrics.observe("vc_broadcast_user_list_seconds", time.perf_counter() - started)
+
+
+
+def forward_audio_data(sender, audio_data, chunk=None):
+    """
+    近くのユーザーに音声データをそのまま転送します。
+    ペイロードは全受信者で同じオブジェクトを共有し、受信者ごとの音量はヘッダーに入れて再生側で掛けてもらいます。
+    chunk (WebM として解析できたもの) があれば、"vc.bin.v1" の受信者にはクラスターとブロックだけを送り、
+    それ以外の受信者には初期化セグメントを付けた単独でデコードできる音声を送ります。
+    """
+    sender_user = user_positions.get(sender)
+    if not sender_user:
+        sampled_log.warning("no-position", "Could not find position for user: %s", sender)
+        return
+
+    nearby = position_index.nearby(sender)
+    metrics.observe("vc_audio_fanout_size", len(nearby), FANOUT_BUCKETS)
+    for username, _, volume in nearby:
+        user_socket = find_socket_by_username(username)
+        if user_socket:
+            send_forwarded_audio(user_socket, sender_user["id"], volume, audio_data, chunk)
+
+def send_forwarded_audio(user_socket, sender_id, volume, audio_data, chunk):
+    if chunk is None:
+        user_socket.outbound.send_audio(audio_frame(sender_id, volume, audio_data))
+    elif user_socket.streams is not None:
+        for frame, is_init in user_socket.streams.frames(sender_id, volume, chunk):
+            # 初期化セグメントは捨てられると以降のブロックを再生できないので、制御メッセージとして送る
+            if is_init:
+                user_socket.outbound.send(frame)
+            else:
+                user_socket.outbound.send_audio(frame)
+    else:
+        user_socket.outbound.send_audio(audio_frame(sender_id, volume, chunk.standalone()))
+
+def bitrate_tier(distance):
+    """距離に対応する BITRATE_TIERS の段の番号を返します。"""
+    for tier, (max_distance, _) in enumerate(BITRATE_TIERS):
+        if distance <= max_distance:
+            return tier
+    return len(BITRATE_TIERS) - 1
+
+async def relay_tiered_audio(sender, audio_data, chunk=None):
+    """
+    近くのユーザーを距離で BITRATE_TIERS の段に分け、段ごとのビットレートでエンコードし直した音声を転送します。
+    エンコードし直すのは1つの音声につき段ごとに1回だけで、同じ段の受信者には同じデータを送ります。
+    そのまま転送する段 (とエンコードし直せなかった場合) は forward と同じ送り方をします。
+    """
+    sender_user = user_positions.get(sender)
+    if not sender_user:
+        sampled_log.warning("no-position", "Could not find position for user: %s", sender)
+        return
 
+    # 距離は calculate_distance と同じもので、position_index.nearby() がグリッドで絞った相手の分だけまとめて計算する
+    nearby = position_index.nearby(sender)
+    metrics.observe("vc_audio_fanout_size", len(nearby), FANOUT_BUCKETS)
+    tiers = {}  # 段の番号 -> [(user_socket, volume), ...]
+    for username, distance, volume in nearby:
+        user_socket = find_socket_by_username(username)
+        if user_socket:
+            tiers.setdefault(bitrate_tier(distance), []).append((user_socket, volume))
+    if not tiers:
+        return
 
+    source = audio_data if chunk is None else chunk.standalone()
+    bitrates = sorted({BITRATE_TIERS[tier][1] for tier in tiers if BITRATE_TIERS[tier][1] is not None})
+    encoded = await tier_transcoder.apply(source, bitrates)
+    for tier, listeners in tiers.items():
+        data = encoded.get(BITRATE_TIERS[tier][1])
+        for user_socket, volume in listeners:
+            if data is None:
+                send_forwarded_audio(user_socket, sender_user["id"], volume, audio_data, chunk)
+            else:
+                user_socket.outbound.send_audio(audio_frame(sender_user["id"], volume, data))
+        metrics.inc("vc_tier_listeners_total", len(listeners), tier=str(tier))
+        metrics.inc("vc_tier_bytes_total", len(source if data is None else data) * len(listeners), tier=str(tier))
 
 async def broadcast_audio_data(sender, audio_data):
-    global user_positions
-    sender_position = next((u["position"] for u in user_positions if u["username"] == sender), None)
+    sender_position = user_positions.get(sender, {}).get("position")
 
     if sender_position:
-        nearby_users = get_nearby_users(sender)
-        for user in nearby_users:
-            user_socket = find_socket_by_username(user["username"])
+        # 距離と音量 (最大音量0.5) は position_index.nearby() がグリッドで絞った相手の分だけまとめて計算する
+        nearby = position_index.nearby(sender)
+        metrics.observe("vc_audio_fanout_size", len(nearby), FANOUT_BUCKETS)
+        targets = []
+        for username, distance, volume in nearby:
+            user_socket = find_socket_by_username(username)
             if user_socket:
-                receiver_position = next((u["position"] for u in user_positions if u["username"] == user["username"]), None)
-                if receiver_position:
-                    distance = calculate_distance(sender_position, receiver_position)
-                    volume = get_volume_by_distance(distance, max_volume=0.5)  # 最大音量を0.5に設定
-                    adjusted_audio_data = await adjust_volume(audio_data, volume)
-
-                    # 送信するデータを確認 (先頭の数バイトを出力)
-                    # print(f"Sending audio data to {user['username']}: {adjusted_audio_data[:16]}")
-
-                    if adjusted_audio_data[:4] == b'OggS':
-                        print(f"Valid Opus header found for {user['username']}")
-                    else:
-                        print(f"Invalid Opus header for {user['username']}: {adjusted_audio_data[:4]}")
-                    try:
-                        await user_socket.send(adjusted_audio_data)
-                    except Exception as e:
-                        print(f"Error sending audio data to {user['username']}: {e}")
+                targets.append((username, user_socket, volume))
+            else:
+                sampled_log.debug("no-socket", "Could not find socket for user: %s", username)
+        if not targets:
+            return
+        # 音量の調整は executor で行い、同じ音量に丸められる受信者の分は1回で済ませる
+        adjusted = await gain_processor.apply(audio_data, [volume for _, _, volume in targets])
+        sender_id = user_positions[sender]["id"]
+        for (username, user_socket, volume), result in zip(targets, adjusted):
+            if result is None:
+                continue
+            adjusted_audio_data, gain_applied = result
+
+            # 送信するデータを確認 (先頭の数バイトを出力、DEBUG のときだけ間引いて出す)
+            if logger.isEnabledFor(logging.DEBUG):
+                if adjusted_audio_data[:4] == b'OggS':
+                    sampled_log.debug("opus-header", "Valid Opus header found for %s", username)
                 else:
-                    print(f"Could not find position for user: {user['username']}")
+                    sampled_log.debug("opus-header-invalid", "Invalid Opus header for %s: %s", username, adjusted_audio_data[:4])
+            if gain_applied:
+                # 音量は掛け済みなので、再生側でもう一度掛けないようにヘッダーの音量は 1.0 にする
+                user_socket.outbound.send_audio(audio_frame(0, 1.0, adjusted_audio_data))
             else:
-                print(f"Could not find socket for user: {user['username']}")
+                # 音量を掛けられなかった音声 (PyAV が無い・デコードできない) は再生側で音量を掛けてもらう
+                user_socket.outbound.send_audio(audio_frame(sender_id, volume, adjusted_audio_data))
     else:
-        print(f"Could not find position for user: {sender}")
-
-async def adjust_volume(audio_data, volume):
-    # Opus ヘッダーを解析してデータ部分の開始位置を探す
-    if audio_data[:4] != b'OggS':
-        print("Not an Ogg Opus file")
-        return audio_data  # Opus データでない場合はそのまま返す
-
-    # 簡易的なヘッダーチェック: ヘッダーサイズが小さいと仮定してスキップ
-    header_size = 50
-    audio_frames = audio_data[header_size:]
-
-    # 音声データを NumPy 配列に変換 (16ビット整数を仮定)
-    audio_np = np.frombuffer(audio_frames, dtype=np.int16)
-
-    # 音量を調整
-    adjusted_audio_np = np.round(audio_np * volume).astype(np.int16)
-
-    # 調整された音声データをバイト列に戻す
-    adjusted_audio_data = adjusted_audio_np.tobytes()
+        sampled_log.warning("no-position", "Could not find position for user: %s", sender)
+
+def plan_audio_mix(speakers):
+    # 話者ごとに近くの受信者を調べ、受信者ごとに (話者, 音量) をまとめる
+    plan = {}
+    for speaker in speakers:
+        for listener, _, volume in position_index.nearby(speaker):
+            # 音量を丸めておくと、同じ話者を同じ音量で聞く受信者のミックスを共有できる
+            plan.setdefault(listener, []).append((speaker, quantize_gain(volume, GAIN_BUCKET_DB)))
+    return plan
+
+async def mix_audio():
+    while True:
+        await asyncio.sleep(AUDIO_MIX_INTERVAL)
+        mixes = await audio_mixer.mix(plan_audio_mix)
+        metrics.observe("vc_audio_fanout_size", len(mixes), FANOUT_BUCKETS)
+        for listener, mixed_audio_data in mixes.items():
+            user_socket = find_socket_by_username(listener)
+            if user_socket:
+                # 複数の話者を混ぜて音量も掛け済みなので、送信者ID 0・音量 1.0 として送る
+                user_socket.outbound.send_audio(audio_frame(0, 1.0, mixed_audio_data))
 
-    return audio_data[:header_size] + adjusted_audio_data
+def admit_message(websocket, kind):
+    """kind のメッセージを処理してよければ True を返します。接続ごとの制限を超えた分は数えて捨てます。"""
+    if websocket.limiter.allow(kind):
+        return True
+    metrics.inc("vc_messages_throttled_total", type=kind)
+    sampled_log.warning("throttled", "Throttled %s messages from %s", kind, websocket.username)
+    return False
 
 def find_socket_by_username(username):
-    for ws in connected_websockets:
-        if hasattr(ws, 'username') and ws.username == username and not ws.closed:
-            return ws
+    ws = sockets_by_username.get(username)
+    if ws and ws.state == websockets.protocol.State.OPEN:
+        return ws
     return None
 
+def create_dsp_executor():
+    # プロセスで実行する関数 (dsp / mixer / vad) はモジュールの関数なので、そのまま渡せる
+    if DSP_EXECUTOR == "process":
+        return ProcessPoolExecutor(max_workers=DSP_WORKERS)
+    return ThreadPoolExecutor(max_workers=DSP_WORKERS)
+
 def get_local_ip_address():
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
@@ -237,37 +555,190 @@ def get_local_ip_address():
     return ip_address
 
 async def background_task():
+    ticker = Ticker(PLAYER_LIST_INTERVAL)
     while True:
         await get_player_list()
-        await broadcast_user_list()
-        await asyncio.sleep(5)
+        user_list_broadcaster.request()
+        await ticker.wait()
+
+async def fetch_position(username, semaphore):
+    async with semaphore:
+        player_data_array = await get_player_data(username)
+    if isinstance(player_data_array, list) and len(player_data_array) > 0 and player_data_array[0].get("position"):
+        player_data = player_data_array[0]
+        set_user_position(username, player_data["position"], parse_dimension(player_data.get("dimension")), SOURCE_POLL)
+    else:
+        motion.defer(username, POSITION_POLL_INTERVAL)
+        sampled_log.warning("invalid-player-data", "Invalid player data for %s: %s", username, player_data_array)
+
+async def fetch_positions_bulk(usernames):
+    """
+    WorldPlayer を引数なしで1回だけ呼び、uniqueId で各ユーザーに座標を振り分けます。
+    振り分けられなかったユーザー名のリストを返します。
+    """
+    player_data_array = await fetch_data("WorldPlayer")
+    if not isinstance(player_data_array, list):
+        return usernames
+
+    players_by_uuid = {
+        player_data.get("uniqueId"): player_data
+        for player_data in player_data_array
+        if isinstance(player_data, dict) and player_data.get("position")
+    }
+    missing = []
+    for username in usernames:
+        player_data = players_by_uuid.get(cached_player_uuids.get(username))
+        if player_data:
+            set_user_position(username, player_data["position"], parse_dimension(player_data.get("dimension")), SOURCE_POLL)
+        else:
+            missing.append(username)
+    return missing
 
 async def update_positions():
-  global user_positions
-  while True:
-        for user_position in user_positions:
-            player_data_array = await get_player_data(user_position["username"])
-            if isinstance(player_data_array, list) and len(player_data_array) > 0 and player_data_array[0].get("position"):
-                player_data = player_data_array[0]
-                user_position["position"] = {
-                    "x": player_data["position"]["x"],
-                    "y": player_data["position"]["y"],
-                    "z": player_data["position"]["z"]
-                }
-            else:
-                print(f"Invalid player data for {user_position['username']}:", player_data_array)
-
-        await broadcast_user_list()
-        await asyncio.sleep(1)
+    """
+    POSITION_TICK_INTERVAL ごとに、問い合わせ時刻を過ぎたユーザーの座標を取得し、
+    それ以外の動いているユーザーは速度から推定した座標で近接検索のインデックスを更新します。
+    問い合わせは別タスクで行うので、APIサーバーが遅くても推定座標の更新は止まりません。
+    """
+    semaphore = asyncio.Semaphore(POSITION_FETCH_CONCURRENCY)
+    ticker = Ticker(POSITION_TICK_INTERVAL)
+    in_flight = {}  # 問い合わせ中のユーザー名 -> タスク
+    while True:
+        now = time.monotonic()
+        # /ingest から座標が届いているユーザーと、問い合わせ中のユーザーは問い合わせない
+        candidates = [
+            username for username in user_positions
+            if username not in in_flight and (ingest is None or not ingest.covers(username))
+        ]
+        usernames = [username for username in candidates if motion.due(username, now)]
+        if usernames:
+            if BULK_POSITION_POLLING:
+                usernames = candidates  # まとめて取得する場合は1回で全員分が手に入る
+            task = asyncio.create_task(poll_positions(usernames, semaphore))
+            for username in usernames:
+                in_flight[username] = task
+
+            def finished(_, usernames=usernames):
+                for username in usernames:
+                    in_flight.pop(username, None)
+            task.add_done_callback(finished)
+
+        if apply_extrapolated_positions(now):
+            user_list_broadcaster.request()
+
+        late = await ticker.wait()
+        if late > POSITION_DRIFT_WARNING:
+            print(f"update_positions is running late: {late:.2f}s behind for {len(user_positions)} users")
+
+async def poll_positions(usernames, semaphore):
+    if BULK_POSITION_POLLING:
+        usernames = await fetch_positions_bulk(usernames)
+    await asyncio.gather(*(fetch_position(username, semaphore) for username in usernames))
+    user_list_broadcaster.request()
+
+def apply_extrapolated_positions(now):
+    """問い合わせの合間に、速度から推定した座標をインデックスに反映します。動かしたユーザーがいれば True を返します。"""
+    moved = 0
+    for username, user in user_positions.items():
+        if ingest.covers(username):
+            # /ingest は動いたプレイヤーの分しか送らないので、止まっても推定が続かないようにする
+            position = motion.settle(username)
+        else:
+            position = motion.extrapolate(username, now)
+        if position is None:
+            continue
+        position_index.update(username, position, user["dimension"])
+        moved += 1
+    if moved:
+        metrics.inc("vc_positions_extrapolated_total", moved)
+    return moved > 0
+
+user_list_changes = UserListChanges(USER_LIST_DISTANCE_THRESHOLD, USER_LIST_VOLUME_THRESHOLD)
+user_list_broadcaster = CoalescedBroadcaster(broadcast_user_list, USER_LIST_BROADCAST_WINDOW)
+
+def apply_ingested_position(username, position, dimension):
+    # ボイスチャットに接続していないプレイヤーの座標は set_user_position が無視する
+    if set_user_position(username, position, dimension, SOURCE_INGEST):
+        user_list_broadcaster.request()
+
+def register_metrics():
+    metrics.describe("vc_messages_received_total", "Messages received from clients by type")
+    metrics.describe("vc_messages_throttled_total", "Messages dropped by the per-connection rate limit by type")
+    metrics.describe("vc_connections_rejected_total", "Connections refused or closed by admission control by reason")
+    metrics.describe("vc_audio_frames_oversized_total", "Audio frames dropped for exceeding MAX_AUDIO_FRAME_BYTES")
+    metrics.describe("vc_audio_fanout_size", "Number of receivers per relayed audio frame")
+    metrics.describe("vc_tier_listeners_total", "Audio deliveries in tiered relay mode by bitrate tier")
+    metrics.describe("vc_tier_bytes_total", "Audio bytes queued for receivers in tiered relay mode by bitrate tier")
+    metrics.describe("vc_broadcast_user_list_seconds", "Duration of each broadcast_user_list pass")
+    metrics.describe("vc_upstream_latency_seconds", "Latency of requests to the game API server")
+    metrics.describe("vc_event_loop_lag_seconds", "How late the event loop wakes up")
+    metrics.gauge("vc_connected_sockets", lambda: len(connected_websockets))
+    metrics.gauge("vc_send_queue_depth", lambda: {
+        "total": sum(len(ws.outbound) for ws in connected_websockets),
+        "max": max((len(ws.outbound) for ws in connected_websockets), default=0),
+    }, label="stat")
+    metrics.counter_from("vc_audio_frames_dropped_total", lambda: OutboundQueue.dropped_frames_total)
+    metrics.counter_from("vc_user_lists_replaced_total", lambda: OutboundQueue.replaced_user_lists_total)
+    metrics.gauge("vc_upstream", lambda: {
+        key: value for key, value in upstream.snapshot().items() if isinstance(value, (int, float))
+    }, label="stat")
+    metrics.gauge("vc_voice_gate", lambda: voice_gate.stats, label="stat")
+    if recorder is not None:
+        metrics.gauge("vc_recorder", lambda: recorder.stats, label="stat")
+    metrics.gauge("vc_player_list_cache", lambda: {
+        **player_list_cache.stats, "age_seconds": player_list_cache.age() or 0.0,
+    }, label="stat")
+    metrics.gauge("vc_gain_processor", lambda: gain_processor.stats, label="stat")
+    metrics.gauge("vc_audio_mixer", lambda: audio_mixer.stats, label="stat")
+    metrics.gauge("vc_tier_transcoder", lambda: tier_transcoder.stats, label="stat")
+    metrics.gauge("vc_speaker_streams", lambda: speaker_streams.stats, label="stat")
+    metrics.gauge("vc_ingest", lambda: {**ingest.stats, "streams": ingest.streams, "healthy": int(ingest.healthy())}, label="stat")
 
 async def main():
     global websocket_server
     global loop
+    global ingest
+    global motion
+    global voice_gate
+    global player_list_cache
+    global recorder
+    global executor
+    global audio_mixer
+    global gain_processor
+    global tier_transcoder
+    global AUDIO_RELAY_MODE
 
     loop = asyncio.get_running_loop()
+    logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    # 接続やリクエストごとのログは出さない
+    logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+    logging.getLogger("websockets.server").setLevel(logging.WARNING)
+    ingest = PositionIngest(apply_ingested_position, INGEST_STALE_AFTER, INGEST_TOKEN)
+    motion = MotionTracker(
+        POSITION_POLL_MIN_INTERVAL,
+        POSITION_POLL_MAX_INTERVAL,
+        POSITION_POLL_STEP,
+        POSITION_EXTRAPOLATION_HORIZON,
+    )
+    executor = create_dsp_executor()
+    audio_mixer = AudioMixer(executor, AUDIO_MIX_BITRATE)
+    gain_processor = GainProcessor(executor, GAIN_BUCKET_DB, AUDIO_VOLUME_BITRATE)
+    tier_transcoder = TierTranscoder(executor)
+    player_list_cache = SingleFlightCache(fetch_player_list, PLAYER_LIST_CACHE_TTL)
+    voice_gate = VoiceActivityGate(VAD_HANGOVER, VAD_SIZE_RATIO, VAD_ENERGY_THRESHOLD, executor=executor)
+    if "energy" in (VAD_MODE, *VAD_USER_MODES.values()) and not energy_available():
+        print("PyAV が無いため energy の音声判定は size で代用します")
+    if RECORD_PATH:
+        recorder = SessionRecorder(RECORD_PATH, RECORD_AUDIO_PAYLOADS, RECORD_MAX_BYTES)
+        print(f"接続・座標・音声を {RECORD_PATH} に記録します")
+    register_metrics()
 
     app = web.Application()
     app.router.add_get('/playerList', send_player_list)
+    app.router.add_get('/upstreamStats', send_upstream_stats)
+    app.router.add_get('/metrics', metrics.handle)
+    app.router.add_get('/ingest', ingest.handle)
+    app.router.add_post('/ingest', ingest.handle)
     app.router.add_get('/{filename:.+}', send_file)
     app.router.add_get('/', send_file)
 
@@ -277,7 +748,8 @@ async def main():
     await http_site.start()
     print(f"HTTP Server listening on port {HTTP_PORT}")
 
-    websocket_server = await websockets.serve(handle_websocket, "0.0.0.0", WS_PORT, subprotocols=["binary"])
+    # 音声は圧縮済みなので permessage-deflate は使わない (受信者ごとの無駄な圧縮を避ける)
+    websocket_server = await websockets.serve(handle_websocket, "0.0.0.0", WS_PORT, subprotocols=[BINARY_SUBPROTOCOL, "binary"], write_limit=WS_WRITE_LIMIT, max_size=WS_MAX_MESSAGE_BYTES, compression=None)
     print(f"WebSocket Server listening on port {WS_PORT}")
 
     ip_address = get_local_ip_address()
@@ -287,10 +759,24 @@ async def main():
     else:
       print("Unable to retrieve server IP address.")
 
-    await asyncio.gather(
-        background_task(),
-        update_positions(),
-    )
+    tasks = [background_task(), update_positions(), metrics.monitor_event_loop()]
+    if AUDIO_RELAY_MODE == "mix":
+        if audio_codec.available:
+            tasks.append(mix_audio())
+        else:
+            print("PyAV is not installed, falling back to AUDIO_RELAY_MODE = \"volume\"")
+            AUDIO_RELAY_MODE = "volume"
+    elif AUDIO_RELAY_MODE == "tiered" and not audio_codec.available:
+        print("PyAV is not installed, falling back to AUDIO_RELAY_MODE = \"forward\"")
+        AUDIO_RELAY_MODE = "forward"
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        await upstream.close()
+        executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import stat as stat_module
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:  # brotli が無い場合は gzip だけ用意する
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# 配信してよいファイルの拡張子。サーバーのソース (.py) や記録ファイルなどは返さない
+STATIC_EXTENSIONS = (
+    ".html", ".htm", ".css", ".js", ".mjs",
+    ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp", ".woff", ".woff2",
+)
+
+
+def parse_accept_encoding(header):
+    """Accept-Encoding を {エンコーディング: q 値} にします。"""
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+class Asset:
+    def __init__(self, path, stat, body):
+        self.path = path
+        self.mtime = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        content_type, _ = mimetypes.guess_type(path)
+        self.content_type = content_type or "application/octet-stream"
+        self.charset = "utf-8" if self.content_type.startswith("text/") else None
+        self.encoded = {}  # "br" / "gzip" -> 圧縮済みの本文
+        self.etags = {}  # "br" / "gzip" -> 圧縮済みの本文の ETag (表現ごとに変える)
+
+    def compress(self, min_size):
+        if len(self.body) < min_size or not self.content_type.startswith(COMPRESSIBLE_TYPES):
+            return
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+        self.encoded["gzip"] = gzip.compress(self.body, mtime=0)
+        for encoding in self.encoded:
+            self.etags[encoding] = self.etag[:-1] + "-" + encoding + '"'
+
+    def choose_encoding(self, accept_encoding):
+        """Accept-Encoding の q 値が最も高い (同じなら br を優先) 圧縮済みの本文の種類を返します。無ければ None です。"""
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_quality = None, 0.0
+        for encoding in ("br", "gzip"):
+            if encoding not in self.encoded:
+                continue
+            quality = accepted.get(encoding, accepted.get("*", 0.0))
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+
+class AssetCache:
+    """
+    root 以下の静的ファイルをメモリに保持し、更新日時が変わったときだけ読み直します。
+    ETag / If-None-Match による 304 と、事前に圧縮しておいた br / gzip の本文を返せます。
+    返すのは extensions の拡張子のファイルだけで、隠しファイルや __pycache__ などの下にあるものは返しません。
+    """
+
+    def __init__(self, root, cache_control="no-cache", compress_min_size=1024, extensions=STATIC_EXTENSIONS):
+        self.root = os.path.realpath(root)
+        self.extensions = extensions
+        self.cache_control = cache_control
+        self.compress_min_size = compress_min_size
+        self.assets = {}  # 実パス -> Asset
+
+    def resolve(self, filename):
+        path = os.path.realpath(os.path.join(self.root, filename))
+        # root の外 (../ やシンボリックリンク経由) は読ませない
+        if os.path.commonpath([path, self.root]) != self.root:
+            return None
+        relative = os.path.relpath(path, self.root)
+        if not relative.lower().endswith(self.extensions):
+            return None
+        if any(part.startswith((".", "__")) for part in relative.split(os.sep)):
+            return None
+        return path
+
+    def get(self, filename):
+        path = self.resolve(filename)
+        if path is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.assets.pop(path, None)
+            return None
+        if not stat_module.S_ISREG(stat.st_mode):
+            return None
+
+        asset = self.assets.get(path)
+        if asset is None or asset.mtime != stat.st_mtime_ns or asset.size != stat.st_size:
+            with open(path, "rb") as f:
+                asset = Asset(path, stat, f.read())
+            asset.compress(self.compress_min_size)
+            self.assets[path] = asset
+        return asset
+
+    def response(self, request, filename):
+        asset = self.get(filename)
+        if asset is None:
+            return web.Response(text="File not found", status=404)
+
+        # 圧縮の有無で本文が変わるので、ETag も表現ごとに変える
+        encoding = asset.choose_encoding(request.headers.get("Accept-Encoding", ""))
+        etag = asset.etag if encoding is None else asset.etags[encoding]
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        if_none_match = request.headers.get("If-None-Match", "")
+        # If-None-Match は弱い比較 (W/ の有無は無視する)
+        tags = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+        if if_none_match.strip() == "*" or etag in tags:
+            headers.pop("Content-Encoding", None)
+            return web.Response(status=304, headers=headers)
+
+        body = asset.body if encoding is None else asset.encoded[encoding]
+        return web.Response(body=body, headers=headers, content_type=asset.content_type, charset=asset.charset)
@@ -0,0 +1,66 @@
+import io
+
+import numpy as np
+
+try:
+    import av
+except ImportError:  # PyAV が無い場合はデコード・エンコードを使う機能を無効にする
+    av = None
+
+SAMPLE_RATE = 48000
+
+available = av is not None
+
+
+def decode_audio(data):
+    """
+    WebM/Ogg の Opus 音声を 48kHz モノラルの float32 配列にデコードします。
+    デコードできなかった場合は None を返します。
+    """
+    try:
+        container = av.open(io.BytesIO(data))
+    except Exception:
+        return None
+    resampler = av.AudioResampler(format="flt", layout="mono", rate=SAMPLE_RATE)
+    chunks = []
+    try:
+        for frame in container.decode(audio=0):
+            for resampled in resampler.resample(frame):
+                chunks.append(resampled.to_ndarray().reshape(-1))
+        for resampled in resampler.resample(None):
+            chunks.append(resampled.to_ndarray().reshape(-1))
+    except Exception:
+        # 途中で壊れていてもデコードできた分は使う
+        pass
+    finally:
+        container.close()
+    if not chunks:
+        return None
+    return np.concatenate(chunks)
+
+
+def decode_frames(frames):
+    """複数の音声データを順にデコードしてつなげます。"""
+    decoded = [pcm for pcm in (decode_audio(data) for data in frames) if pcm is not None]
+    if not decoded:
+        return None
+    return np.concatenate(decoded)
+
+
+def encode_audio(pcm, bitrate=64000, container_format="webm"):
+    """48kHz モノラルの float32 配列を Opus でエンコードし、WebM (または Ogg) のバイト列にします。"""
+    output = io.BytesIO()
+    container = av.open(output, "w", format=container_format)
+    stream = container.add_stream("libopus", rate=SAMPLE_RATE)
+    stream.bit_rate = bitrate
+    stream.layout = "mono"
+    frame = av.AudioFrame.from_ndarray(
+        np.ascontiguousarray(pcm, dtype=np.float32).reshape(1, -1), format="flt", layout="mono"
+    )
+    frame.sample_rate = SAMPLE_RATE
+    for packet in stream.encode(frame):
+        container.mux(packet)
+    for packet in stream.encode(None):
+        container.mux(packet)
+    container.close()
+    return output.getvalue()
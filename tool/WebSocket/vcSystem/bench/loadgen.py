@@ -0,0 +1,405 @@
+"""
+vcSystem の負荷試験です。モックのゲームAPIと計測対象のサーバーを起動し、
+指定した人数のクライアントに setPosition と音声を送らせて次の値を計測します。
+
+  - 音声の中継遅延 (話者が送ってから近くの受信者に届くまで) の p50 / p99
+  - userList の遅延 (setPosition を送ってから次の userList が届くまで) の p50 / p99
+  - サーバープロセスの CPU 時間
+  - サーバーが送ったバイト数とメッセージ数
+
+    python bench/loadgen.py --server index --speakers 50 --duration 30
+    python bench/loadgen.py --server a --speakers 200 --json result.json --set BULK_POSITION_POLLING=True
+    python bench/loadgen.py --server index --protocol binary
+    python bench/loadgen.py --server index --ingest
+    python bench/loadgen.py --server a --protocol binary --continuation --silence-ratio 0.5
+
+音声は実際のクライアント (MediaRecorder) と同じく WebM として解析できる形で送るので、
+サーバーの WebM の解析と、初期化セグメント / クラスターに分けた中継の経路を計測できます。
+--continuation を付けると、各クライアントは最初の1回だけ EBML ヘッダーから始まる音声を送り、
+以降は録音中のストリームの続き (SimpleBlock だけのチャンク) を送ります。
+--silence-ratio の割合の音声は --silence-size の大きさ (無音) で送るので、VAD が捨てた割合を計測できます
+(サーバーは vc.bin.v1 でないクライアントを自分で無音を捨てているものとして扱うので、--protocol binary と一緒に使います)。
+
+--set はサーバーのモジュール定数を上書きします (起動時に読まれる定数には効きません)。
+mix モードでは音声がサーバーで作り直されるので、音声の中継遅延は計測できません。
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import statistics
+import struct
+import sys
+import time
+
+import aiohttp
+import websockets
+
+from mock_api import MockGameApi, create_players
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# WebM (container.py と同じ要素 ID)
+EBML_ID = b"\x1a\x45\xdf\xa3"
+SEGMENT_ID = b"\x18\x53\x80\x67"
+INFO_ID = b"\x15\x49\xa9\x66"
+TRACKS_ID = b"\x16\x54\xae\x6b"
+CLUSTER_ID = b"\x1f\x43\xb6\x75"
+TIMECODE_ID = b"\xe7"
+SIMPLE_BLOCK_ID = b"\xa3"
+UNKNOWN_SIZE = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+MSG_AUDIO_CHUNK = b"\x04"  # protocol.py の MSG_AUDIO_CHUNK
+BENCH_MARKER = b"BENCH"
+BENCH_STAMP = struct.Struct(">dI")  # 送信時刻 (perf_counter) / 連番
+AUDIO_HEADER_MAGIC = b"VC"
+AUDIO_HEADER_SIZE = 10
+AUDIO_HEADER_KIND_OFFSET = 3  # framing.py の AUDIO_HEADER の kind
+FRAME_KIND_INIT = 1  # framing.py の FRAME_KIND_INIT
+BINARY_SUBPROTOCOL = "vc.bin.v1"
+BINARY_SET_POSITION = struct.Struct("<B3fh")  # protocol.py の MSG_SET_POSITION
+BINARY_MESSAGE_TYPES = {0x02: "userList", 0x03: "userNames"}
+
+
+def ebml_element(element_id, body):
+    """サイズを 8 バイトの可変長整数で書いた EBML 要素を返します。"""
+    return element_id + (len(body) | (1 << 56)).to_bytes(8, "big") + body
+
+
+# 各ストリームの先頭 (初期化セグメントになる部分): EBML ヘッダー / Segment (サイズ不明) / Info / Tracks
+STREAM_HEADER = (
+    ebml_element(EBML_ID, ebml_element(b"\x42\x82", b"webm"))  # DocType
+    + SEGMENT_ID + UNKNOWN_SIZE
+    + ebml_element(INFO_ID, ebml_element(b"\x2a\xd7\xb1", (1000000).to_bytes(3, "big")))  # TimecodeScale
+    + ebml_element(TRACKS_ID, ebml_element(b"\xae", (  # TrackEntry
+        ebml_element(b"\xd7", b"\x01")  # TrackNumber
+        + ebml_element(b"\x83", b"\x02")  # TrackType (audio)
+        + ebml_element(b"\x86", b"A_OPUS")  # CodecID
+    )))
+)
+
+
+def make_audio_frame(size, sent_at, sequence, continuation=False):
+    """
+    送信時刻を埋め込んだ SimpleBlock を1つ持つ、計測用の WebM のチャンクを作ります (全体でおよそ size バイト)。
+    continuation でなければ EBML ヘッダーから最初のクラスターまでを付けた新しいストリームの先頭にし、
+    continuation なら録音中のストリームの続き (SimpleBlock だけ) にします。
+    """
+    head = b"" if continuation else (
+        STREAM_HEADER + CLUSTER_ID + UNKNOWN_SIZE + ebml_element(TIMECODE_ID, (0).to_bytes(4, "big"))
+    )
+    # トラック番号 (可変長整数) / クラスターからの相対時刻 (int16) / フラグ (キーフレーム)、続けてフレーム
+    block_header = b"\x81" + ((sequence * 20) & 0x7FFF).to_bytes(2, "big") + b"\x80"
+    stamp = BENCH_MARKER + BENCH_STAMP.pack(sent_at, sequence)
+    padding = max(0, size - len(head) - 9 - len(block_header) - len(stamp))
+    frame = head + ebml_element(SIMPLE_BLOCK_ID, block_header + stamp + b"\0" * padding)
+    return MSG_AUDIO_CHUNK + frame if continuation else frame
+
+
+def read_audio_stamp(message):
+    """受け取った音声から make_audio_frame が埋め込んだ送信時刻を探して返します。無ければ None です。"""
+    offset = bytes(message).find(BENCH_MARKER)
+    if offset < 0 or offset + len(BENCH_MARKER) + BENCH_STAMP.size > len(message):
+        return None
+    sent_at, _ = BENCH_STAMP.unpack_from(message, offset + len(BENCH_MARKER))
+    return sent_at
+
+
+def audio_message_kind(message):
+    """VC ヘッダーの kind が初期化セグメントなら "audioInit"、それ以外は "audio" を返します。"""
+    if message[:2] == AUDIO_HEADER_MAGIC and message[AUDIO_HEADER_KIND_OFFSET] == FRAME_KIND_INIT:
+        return "audioInit"
+    return "audio"
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Stats:
+    def __init__(self):
+        self.recording = False
+        self.audio_latencies = []
+        self.user_list_latencies = []
+        self.user_list_unanswered = 0
+        self.bytes_received = 0
+        self.messages_received = {}
+        self.audio_sent = 0
+        self.positions_sent = 0
+
+    def count(self, kind, size):
+        if not self.recording:
+            return
+        self.bytes_received += size
+        self.messages_received[kind] = self.messages_received.get(kind, 0) + 1
+
+
+class SimulatedClient:
+    def __init__(self, player, args, stats, started):
+        self.player = player
+        self.args = args
+        self.stats = stats
+        self.started = started
+        self.position_sent_at = None
+        self.random = random.Random(f"{args.seed}-{player.name}")
+
+    async def run(self, url, stop):
+        subprotocols = [BINARY_SUBPROTOCOL] if self.args.protocol == "binary" else ["binary"]
+        async with websockets.connect(f"{url}/?username={self.player.name}", subprotocols=subprotocols,
+                                      max_size=None, compression=None) as websocket:
+            receiver = asyncio.create_task(self.receive(websocket))
+            try:
+                await asyncio.gather(self.send_positions(websocket, stop), self.send_audio(websocket, stop))
+            finally:
+                receiver.cancel()
+
+    async def send_positions(self, websocket, stop):
+        interval = 1.0 / self.args.position_rate
+        while not stop.is_set():
+            now = time.monotonic() - self.started
+            if self.position_sent_at is not None and self.stats.recording:
+                self.stats.user_list_unanswered += 1
+            self.position_sent_at = time.perf_counter()
+            position = self.player.position(now)
+            if websocket.subprotocol == BINARY_SUBPROTOCOL:
+                await websocket.send(BINARY_SET_POSITION.pack(0x01, position["x"], position["y"], position["z"], 0))
+            else:
+                await websocket.send(json.dumps({"type": "setPosition", "position": position}))
+            if self.stats.recording:
+                self.stats.positions_sent += 1
+            try:
+                await asyncio.wait_for(stop.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def send_audio(self, websocket, stop):
+        sequence = 0
+        while not stop.is_set():
+            continuation = self.args.continuation and sequence > 0
+            silent = continuation and self.random.random() < self.args.silence_ratio
+            size = self.args.silence_size if silent else self.args.frame_size
+            await websocket.send(make_audio_frame(size, time.perf_counter(), sequence, continuation))
+            if self.stats.recording:
+                self.stats.audio_sent += 1
+            sequence += 1
+            await asyncio.sleep(self.args.frame_interval)
+
+    async def receive(self, websocket):
+        async for message in websocket:
+            received_at = time.perf_counter()
+            if isinstance(message, str):
+                data = json.loads(message)
+                kind = data.get("type", "unknown")
+                self.stats.count(kind, len(message.encode()))
+                if kind == "userList" and self.position_sent_at is not None:
+                    if self.stats.recording:
+                        self.stats.user_list_latencies.append(received_at - self.position_sent_at)
+                    self.position_sent_at = None
+            elif message[:1] and message[0] in BINARY_MESSAGE_TYPES:
+                kind = BINARY_MESSAGE_TYPES[message[0]]
+                self.stats.count(kind, len(message))
+                if kind == "userList" and self.position_sent_at is not None:
+                    if self.stats.recording:
+                        self.stats.user_list_latencies.append(received_at - self.position_sent_at)
+                    self.position_sent_at = None
+            else:
+                self.stats.count(audio_message_kind(message), len(message))
+                sent_at = read_audio_stamp(message)
+                if sent_at is not None and self.stats.recording:
+                    self.stats.audio_latencies.append(received_at - sent_at)
+
+
+def read_cpu_seconds(pid):
+    """
+    /proc から子プロセスの CPU 時間 (user + system) を読みます。読めなければ None を返します。
+    サーバーがワーカープロセスを起動している場合 (CLUSTER_WORKERS) はその分も足します。
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        children = []
+    for child in children:
+        seconds += read_cpu_seconds(child) or 0.0
+    return seconds
+
+
+async def fetch_voice_gate_stats(http_port):
+    """サーバーの /metrics から VAD の件数 (vc_voice_gate) を読みます。読めなければ None を返します。"""
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{http_port}/metrics?format=json") as response:
+                gauges = (await response.json())["gauges"]
+    except (aiohttp.ClientError, ValueError, KeyError):
+        return None
+    return {stat: gauges.get(f'vc_voice_gate{{stat="{stat}"}}', 0) for stat in ("passed", "dropped", "hangover")}
+
+
+def voice_gate_summary(before, after):
+    if before is None or after is None:
+        return None
+    counts = {stat: after[stat] - before[stat] for stat in after}
+    total = sum(counts.values())
+    return dict(counts, drop_rate=round(counts["dropped"] / total, 3) if total else None)
+
+
+async def wait_for_server(url, timeout=15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with websockets.connect(f"{url}/", subprotocols=["binary"]):
+                return
+        except (OSError, websockets.exceptions.InvalidHandshake, websockets.exceptions.ConnectionClosed):
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"Server did not start listening on {url}")
+
+
+async def start_server(args, api_url):
+    command = [
+        sys.executable, os.path.join(BENCH_DIR, "serve.py"),
+        "--server", args.server,
+        "--api-url", api_url,
+        "--http-port", str(args.http_port),
+        "--ws-port", str(args.ws_port),
+    ]
+    for override in args.set:
+        command += ["--set", override]
+    return await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.DEVNULL if args.quiet else None
+    )
+
+
+def summarize(args, stats, cpu_seconds, measured, upstream_requests, voice_gate=None):
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "server": args.server,
+        "speakers": args.speakers,
+        "duration": round(measured, 2),
+        "settings": args.set,
+        "protocol": args.protocol,
+        "audio_latency_ms": {
+            "p50": ms(percentile(stats.audio_latencies, 0.5)),
+            "p99": ms(percentile(stats.audio_latencies, 0.99)),
+            "mean": ms(statistics.fmean(stats.audio_latencies)) if stats.audio_latencies else None,
+            "samples": len(stats.audio_latencies),
+        },
+        "user_list_latency_ms": {
+            "p50": ms(percentile(stats.user_list_latencies, 0.5)),
+            "p99": ms(percentile(stats.user_list_latencies, 0.99)),
+            "samples": len(stats.user_list_latencies),
+            "unanswered": stats.user_list_unanswered,
+        },
+        "server_cpu_seconds": None if cpu_seconds is None else round(cpu_seconds, 3),
+        "server_cpu_percent": None if cpu_seconds is None else round(100 * cpu_seconds / measured, 1),
+        "bytes_sent_by_server": stats.bytes_received,
+        "bytes_per_second": round(stats.bytes_received / measured),
+        "messages_sent_by_server": stats.messages_received,
+        "audio_frames_sent_by_clients": stats.audio_sent,
+        "positions_sent_by_clients": stats.positions_sent,
+        "upstream_requests": upstream_requests,
+        "voice_gate": voice_gate,
+    }
+
+
+async def run(args):
+    started = time.monotonic()
+    players = create_players(args.speakers, args.seed)
+    api = MockGameApi(players, started)
+    api_runner = await api.start(port=args.api_port)
+    api_url = f"http://127.0.0.1:{args.api_port}/api/get"
+    url = f"ws://127.0.0.1:{args.ws_port}"
+
+    process = None if args.external else await start_server(args, api_url)
+    pusher = None
+    try:
+        await wait_for_server(url)
+        if args.ingest:
+            pusher = asyncio.create_task(
+                api.stream_positions(f"ws://127.0.0.1:{args.http_port}/ingest", args.ingest_interval)
+            )
+        stats = Stats()
+        stop = asyncio.Event()
+        clients = []
+        for player in players:
+            client = SimulatedClient(player, args, stats, started)
+            clients.append(asyncio.create_task(client.run(url, stop)))
+            await asyncio.sleep(args.connect_interval)
+
+        await asyncio.sleep(args.warmup)
+        cpu_before = None if process is None else read_cpu_seconds(process.pid)
+        requests_before = dict(api.requests, ingest=api.pushed)
+        voice_gate_before = await fetch_voice_gate_stats(args.http_port)
+        measure_started = time.perf_counter()
+        stats.recording = True
+        await asyncio.sleep(args.duration)
+        stats.recording = False
+        measured = time.perf_counter() - measure_started
+        upstream_requests = {
+            key: value - requests_before[key] for key, value in dict(api.requests, ingest=api.pushed).items()
+        }
+        cpu_after = None if process is None else read_cpu_seconds(process.pid)
+        voice_gate = voice_gate_summary(voice_gate_before, await fetch_voice_gate_stats(args.http_port))
+
+        stop.set()
+        await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        if pusher is not None:
+            pusher.cancel()
+        if process is not None and process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            await process.wait()
+        await api_runner.cleanup()
+
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return summarize(args, stats, cpu_seconds, measured, upstream_requests, voice_gate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="vcSystem の負荷試験")
+    parser.add_argument("--server", default="index", help="計測するサーバー (index または a)")
+    parser.add_argument("--speakers", type=int, default=50, help="同時に話すクライアント数")
+    parser.add_argument("--duration", type=float, default=20.0, help="計測する秒数")
+    parser.add_argument("--warmup", type=float, default=3.0, help="全員の接続後、計測を始めるまでの秒数")
+    parser.add_argument("--frame-interval", type=float, default=0.5, help="音声を送る間隔 (秒)")
+    parser.add_argument("--frame-size", type=int, default=4000, help="音声1回分のバイト数")
+    parser.add_argument("--continuation", action="store_true",
+                        help="最初の1回以外はヘッダーの無い、録音中のストリームの続きとして音声を送る")
+    parser.add_argument("--silence-ratio", type=float, default=0.0, help="--continuation のとき、無音として送る音声の割合")
+    parser.add_argument("--silence-size", type=int, default=200, help="無音の音声1回分のバイト数")
+    parser.add_argument("--position-rate", type=float, default=1.0, help="setPosition を送る回数 (回/秒)")
+    parser.add_argument("--connect-interval", type=float, default=0.01, help="クライアントを接続する間隔 (秒)")
+    parser.add_argument("--protocol", choices=("json", "binary"), default="json",
+                        help="setPosition / userList の形式 (binary は vc.bin.v1 サブプロトコル)")
+    parser.add_argument("--ingest", action="store_true", help="モックのゲームAPIからサーバーの /ingest に座標を送る")
+    parser.add_argument("--ingest-interval", type=float, default=0.1, help="/ingest に座標を送る間隔 (秒)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-port", type=int, default=15000)
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--ws-port", type=int, default=18133)
+    parser.add_argument("--external", action="store_true", help="サーバーを起動せず、起動済みのサーバーに接続する")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="サーバーの定数を上書きする")
+    parser.add_argument("--json", help="結果を JSON で保存するファイル")
+    parser.add_argument("--quiet", action="store_true", help="サーバーの標準出力を捨てる")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+API_BASE_URL (localhost:5000/api/get) の代わりになる負荷試験用のモックです。
+playerList と WorldPlayer だけを返し、プレイヤーは決まった動き (円運動 / 静止) をします。
+stream_positions はゲーム側のブリッジの代わりに、サーバーの /ingest へ座標を送り続けます。
+
+単体で起動する場合:
+    python bench/mock_api.py --players 200 --port 5000
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+
+CLUSTER_SIZE = 10  # 1か所に集まるプレイヤー数
+CLUSTER_SPACING = 100  # 集まり同士の間隔 (ブロック)。可聴距離より十分離す
+
+
+class PlayerScript:
+    """プレイヤー1人分の動き。時刻を渡すとその時の座標を返します。"""
+
+    def __init__(self, name, index, rng):
+        cluster = index // CLUSTER_SIZE
+        self.name = name
+        self.uuid = f"-{index + 1:012d}"
+        self.dimension = 0
+        self.center = (cluster * CLUSTER_SPACING, 64.0, 0.0)
+        self.radius = rng.uniform(2.0, 12.0)
+        self.phase = rng.uniform(0.0, 2 * math.pi)
+        # 2割のプレイヤーはその場から動かない
+        self.angular_speed = 0.0 if rng.random() < 0.2 else rng.uniform(0.2, 1.0)
+
+    def position(self, now):
+        angle = self.phase + self.angular_speed * now
+        return {
+            "x": self.center[0] + self.radius * math.cos(angle),
+            "y": self.center[1],
+            "z": self.center[2] + self.radius * math.sin(angle),
+        }
+
+
+def create_players(count, seed=1):
+    rng = random.Random(seed)
+    return [PlayerScript(f"player{index:03d}", index, rng) for index in range(count)]
+
+
+class MockGameApi:
+    def __init__(self, players, started=None):
+        self.players = {player.name: player for player in players}
+        self.started = time.monotonic() if started is None else started
+        self.requests = {"playerList": 0, "WorldPlayer": 0}
+        self.pushed = 0  # /ingest に送った座標の数
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def world_player(self, player, now):
+        return {
+            "name": player.name,
+            "uniqueId": player.uuid,
+            "dimension": player.dimension,
+            "position": player.position(now),
+        }
+
+    async def handle(self, request):
+        item = request.match_info["item"]
+        if item not in self.requests:
+            return web.json_response({"error": "Item not found."}, status=404)
+        self.requests[item] += 1
+
+        if item == "playerList":
+            return web.json_response([{"name": p.name, "uuid": p.uuid} for p in self.players.values()])
+
+        now = self.elapsed()
+        player_name = request.query.get("playerName")
+        if player_name is None:
+            return web.json_response([self.world_player(p, now) for p in self.players.values()])
+        player = self.players.get(player_name)
+        return web.json_response([self.world_player(player, now)] if player else [])
+
+    async def stream_positions(self, url, interval=0.1):
+        """url (サーバーの /ingest) に WebSocket で接続し、最初に全員分、その後は動いたプレイヤーの座標だけを送ります。"""
+        sent = {}
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(url) as ws:
+                while True:
+                    now = self.elapsed()
+                    updates = []
+                    for player in self.players.values():
+                        data = self.world_player(player, now)
+                        if sent.get(player.name) != data["position"]:
+                            sent[player.name] = data["position"]
+                            updates.append(data)
+                    await ws.send_str(json.dumps(updates) if updates else '{"type": "heartbeat"}')
+                    self.pushed += len(updates)
+                    await asyncio.sleep(interval)
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get("/api/get/{item}", self.handle)
+        return app
+
+    async def start(self, host="127.0.0.1", port=5000):
+        runner = web.AppRunner(self.create_app())
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="vcSystem 負荷試験用のゲームAPIモック")
+    parser.add_argument("--players", type=int, default=50)
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    api = MockGameApi(create_players(args.players, args.seed))
+    await api.start(port=args.port)
+    print(f"Mock game API listening on port {args.port} with {args.players} players")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
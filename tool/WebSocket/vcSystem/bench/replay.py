@@ -0,0 +1,325 @@
+"""
+RECORD_PATH で記録したセッションを、計測対象のサーバーに同じタイミングで (または速めて) 流し直します。
+実際のトラフィックの形のまま、バージョン間で userList の送信や音声の配信にかかる時間を比べるためのものです。
+
+  - 接続・切断とクライアントの setPosition は、記録したユーザー名で WebSocket から送り直す
+  - ポーリングで取得した座標はモックのゲームAPIが同じ時刻に返すようにする (サーバーは普段どおり問い合わせる)
+  - /ingest で受け取った座標はサーバーの /ingest に送り直す
+  - 音声は中身を記録していればそれを、大きさだけなら同じ大きさの計測用のダミー (送信時刻入り) を送る
+
+    python bench/replay.py session.vcrec --server index
+    python bench/replay.py session.vcrec --server a --speed 4 --json replay-a.json
+    python bench/replay.py session.vcrec --server index --set CLUSTER_WORKERS=2
+
+速めて流すとクライアントごとのメッセージの頻度も上がるので、必要なら --set RATE_LIMITS=... で制限を緩めます。
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import sys
+import time
+
+import aiohttp
+import websockets
+
+from loadgen import (
+    BINARY_SET_POSITION, BINARY_SUBPROTOCOL, make_audio_frame, percentile, read_audio_stamp,
+    read_cpu_seconds, start_server, wait_for_server,
+)
+from mock_api import MockGameApi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from recorder import (  # noqa: E402
+    DIMENSION_UNKNOWN, REC_AUDIO, REC_CONNECT, REC_DISCONNECT, REC_POSITION,
+    SOURCE_CLIENT, SOURCE_POLL, read_sessions,
+)
+
+# サーバーの /metrics から取り出すヒストグラム
+REPORTED_HISTOGRAMS = (
+    "vc_broadcast_user_list_seconds",
+    "vc_audio_fanout_size",
+    "vc_event_loop_lag_seconds",
+    "vc_upstream_latency_seconds",
+)
+
+
+class ReplayPlayer:
+    """MockGameApi に渡すプレイヤー。記録にあるポーリング結果の座標をそのまま返します。"""
+
+    def __init__(self, name):
+        self.name = name
+        self.uuid = f"replay-{name}"
+        self.dimension = 0
+        self.current = {"x": 0.0, "y": 0.0, "z": 0.0}
+
+    def position(self, now):
+        return self.current
+
+
+class ReplayClient:
+    """記録の1ユーザー分の WebSocket 接続です。接続が開く前に届いたメッセージはキューで待たせます。"""
+
+    def __init__(self, username, binary_protocol, stats):
+        self.username = username
+        self.binary_protocol = binary_protocol
+        self.stats = stats
+        self.queue = asyncio.Queue()
+
+    async def run(self, url):
+        subprotocols = [BINARY_SUBPROTOCOL] if self.binary_protocol else ["binary"]
+        try:
+            async with websockets.connect(f"{url}/?username={self.username}", subprotocols=subprotocols,
+                                          max_size=None, compression=None) as websocket:
+                receiver = asyncio.create_task(self.receive(websocket))
+                try:
+                    while (message := await self.queue.get()) is not None:
+                        await websocket.send(message)
+                finally:
+                    receiver.cancel()
+        except (OSError, websockets.exceptions.WebSocketException) as error:
+            self.stats.errors.append(f"{self.username}: {error}")
+
+    async def receive(self, websocket):
+        async for message in websocket:
+            received_at = time.perf_counter()
+            self.stats.bytes_received += len(message)
+            if isinstance(message, bytes):
+                sent_at = read_audio_stamp(message)
+                # 記録した中身をそのまま流した音声には記録時の送信時刻が入っているので数えない
+                if sent_at is not None and sent_at >= self.stats.started_at:
+                    self.stats.audio_latencies.append(received_at - sent_at)
+
+
+class Stats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.audio_latencies = []
+        self.schedule_lag = []  # 記録の時刻から何秒遅れて送れたか (再生側が追いつけていないと大きくなる)
+        self.bytes_received = 0
+        self.sent = {"connect": 0, "disconnect": 0, "position_client": 0, "position_poll": 0,
+                     "position_ingest": 0, "audio": 0}
+        self.errors = []
+
+
+class IngestFeed:
+    """サーバーの /ingest への WebSocket。最初の座標で接続し、止まったとみなされないようハートビートも送ります。"""
+
+    def __init__(self, url, heartbeat=1.0):
+        self.url = url
+        self.heartbeat = heartbeat
+        self.session = None
+        self.ws = None
+        self.heartbeat_task = None
+
+    async def send(self, update):
+        if self.ws is None:
+            self.session = aiohttp.ClientSession()
+            self.ws = await self.session.ws_connect(self.url)
+            self.heartbeat_task = asyncio.create_task(self._send_heartbeats())
+        await self.ws.send_str(json.dumps(update))
+
+    async def _send_heartbeats(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            await self.ws.send_str('{"type": "heartbeat"}')
+
+    async def close(self):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        if self.ws is not None:
+            await self.ws.close()
+            await self.session.close()
+
+
+def histogram_summary(snapshot, name):
+    """/metrics?format=json のヒストグラムから件数・平均と、バケットの上限で近似した p50 / p99 を返します。"""
+    histogram = snapshot.get("histograms", {}).get(name)
+    if not histogram or not histogram["count"]:
+        return None
+    count = histogram["count"]
+
+    def quantile(fraction):
+        for bound, total in histogram["buckets"].items():
+            if total >= fraction * count:
+                return bound
+        return "+Inf"
+
+    return {"count": count, "mean": histogram["sum"] / count, "p50_le": quantile(0.5), "p99_le": quantile(0.99)}
+
+
+async def fetch_metrics(http_port):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{http_port}/metrics?format=json") as response:
+            return await response.json()
+
+
+async def play(records, args, api, stats, url):
+    clients = {}
+    tasks = []
+    ingest = IngestFeed(f"ws://127.0.0.1:{args.http_port}/ingest")
+    sequence = 0
+    started = time.monotonic()
+    try:
+        for record in records:
+            delay = started + record.time / args.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            stats.schedule_lag.append(max(0.0, -delay))
+
+            if record.kind == REC_CONNECT:
+                client = clients[record.username] = ReplayClient(
+                    record.username, bool(record.values[0]) if args.protocol == "recorded" else args.protocol == "binary",
+                    stats,
+                )
+                tasks.append(asyncio.create_task(client.run(url)))
+                stats.sent["connect"] += 1
+            elif record.kind == REC_DISCONNECT:
+                client = clients.pop(record.username, None)
+                if client is not None:
+                    client.queue.put_nowait(None)
+                    stats.sent["disconnect"] += 1
+            elif record.kind == REC_POSITION:
+                source, x, y, z, dimension = record.values
+                position = {"x": x, "y": y, "z": z}
+                dimension = None if dimension == DIMENSION_UNKNOWN else dimension
+                if source == SOURCE_CLIENT:
+                    client = clients.get(record.username)
+                    if client is None:
+                        continue
+                    if client.binary_protocol:
+                        message = BINARY_SET_POSITION.pack(
+                            0x01, x, y, z, DIMENSION_UNKNOWN if dimension is None else dimension
+                        )
+                    else:
+                        message = json.dumps({"type": "setPosition", "position": position, "dimension": dimension})
+                    client.queue.put_nowait(message)
+                    stats.sent["position_client"] += 1
+                elif source == SOURCE_POLL:
+                    player = api.players[record.username]
+                    player.current = position
+                    if dimension is not None:
+                        player.dimension = dimension
+                    stats.sent["position_poll"] += 1
+                else:
+                    await ingest.send({"name": record.username, "position": position, "dimension": dimension})
+                    stats.sent["position_ingest"] += 1
+            elif record.kind == REC_AUDIO:
+                client = clients.get(record.username)
+                if client is None:
+                    continue
+                size, has_payload = record.values
+                if has_payload and not args.synthetic_audio:
+                    client.queue.put_nowait(record.payload)
+                else:
+                    client.queue.put_nowait(make_audio_frame(size, time.perf_counter(), sequence))
+                    sequence += 1
+                stats.sent["audio"] += 1
+        await asyncio.sleep(args.drain)
+    finally:
+        for client in clients.values():
+            client.queue.put_nowait(None)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await ingest.close()
+
+
+def summarize(args, records, stats, cpu_seconds, measured, upstream_requests, metrics_snapshot):
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        "recording": args.recording,
+        "session": args.session,
+        "server": args.server,
+        "settings": args.set,
+        "speed": args.speed,
+        "recorded_seconds": round(records[-1].time, 2) if records else 0.0,
+        "duration": round(measured, 2),
+        "sent": stats.sent,
+        "audio_latency_ms": {
+            "p50": ms(percentile(stats.audio_latencies, 0.5)),
+            "p99": ms(percentile(stats.audio_latencies, 0.99)),
+            "mean": ms(statistics.fmean(stats.audio_latencies)) if stats.audio_latencies else None,
+            "samples": len(stats.audio_latencies),
+        },
+        "schedule_lag_ms": {
+            "p99": ms(percentile(stats.schedule_lag, 0.99)),
+            "max": ms(max(stats.schedule_lag, default=None)),
+        },
+        "server_cpu_seconds": None if cpu_seconds is None else round(cpu_seconds, 3),
+        "server_cpu_percent": None if cpu_seconds is None else round(100 * cpu_seconds / measured, 1),
+        "bytes_sent_by_server": stats.bytes_received,
+        "upstream_requests": upstream_requests,
+        "server_histograms": {name: histogram_summary(metrics_snapshot, name) for name in REPORTED_HISTOGRAMS},
+        "errors": stats.errors[:20],
+    }
+
+
+async def run(args):
+    sessions = read_sessions(args.recording)
+    if not sessions:
+        raise SystemExit(f"{args.recording} has no sessions")
+    records = sessions[args.session]
+    names = sorted({record.username for record in records if record.username})
+    api = MockGameApi([ReplayPlayer(name) for name in names])
+    api_runner = await api.start(port=args.api_port)
+    api_url = f"http://127.0.0.1:{args.api_port}/api/get"
+    url = f"ws://127.0.0.1:{args.ws_port}"
+
+    process = None if args.external else await start_server(args, api_url)
+    try:
+        await wait_for_server(url)
+        stats = Stats()
+        cpu_before = None if process is None else read_cpu_seconds(process.pid)
+        requests_before = dict(api.requests)
+        measure_started = time.perf_counter()
+        await play(records, args, api, stats, url)
+        measured = time.perf_counter() - measure_started
+        cpu_after = None if process is None else read_cpu_seconds(process.pid)
+        upstream_requests = {key: value - requests_before[key] for key, value in api.requests.items()}
+        metrics_snapshot = await fetch_metrics(args.http_port)
+    finally:
+        if process is not None and process.returncode is None:
+            process.send_signal(signal.SIGINT)
+            await process.wait()
+        await api_runner.cleanup()
+
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return summarize(args, records, stats, cpu_seconds, measured, upstream_requests, metrics_snapshot)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録したセッションを vcSystem サーバーに流し直す")
+    parser.add_argument("recording", help="RECORD_PATH で記録したファイル")
+    parser.add_argument("--session", type=int, default=-1, help="流すセッションの番号 (既定は最後のセッション)")
+    parser.add_argument("--server", default="index", help="計測するサーバー (index または a)")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度 (2 なら記録の半分の時間で流す)")
+    parser.add_argument("--protocol", choices=("recorded", "json", "binary"), default="recorded",
+                        help="クライアントの接続方法 (recorded は記録したときと同じ)")
+    parser.add_argument("--synthetic-audio", action="store_true",
+                        help="中身を記録した音声も計測用のダミーに置き換える (音声の遅延を測る)")
+    parser.add_argument("--drain", type=float, default=1.0, help="最後のレコードを送ってから終了までに待つ秒数")
+    parser.add_argument("--api-port", type=int, default=15000)
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--ws-port", type=int, default=18133)
+    parser.add_argument("--external", action="store_true", help="サーバーを起動せず、すでに動いているものに流す")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="サーバーのモジュール定数を上書きする (値は Python のリテラル)")
+    parser.add_argument("--json", help="結果を JSON で保存するファイル")
+    parser.add_argument("--quiet", action="store_true", help="サーバーの標準出力を捨てる")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    result = asyncio.run(run(args))
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    print(output)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
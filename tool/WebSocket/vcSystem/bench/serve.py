@@ -0,0 +1,57 @@
+"""
+index.py / a.py の設定値 (ポートや API_BASE_URL など) を上書きしてサーバーを起動します。
+loadgen.py が計測対象のサーバーをこのスクリプト経由で別プロセスとして起動します。
+
+    python bench/serve.py --server index --api-url http://127.0.0.1:15000/api/get \\
+        --http-port 18080 --ws-port 18133 --set BULK_POSITION_POLLING=True
+"""
+import argparse
+import ast
+import asyncio
+import importlib
+import os
+import sys
+
+VC_SYSTEM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_server(name, api_url=None, http_port=None, ws_port=None, overrides=()):
+    sys.path.insert(0, VC_SYSTEM_DIR)
+    server = importlib.import_module(name)
+    if api_url:
+        server.API_BASE_URL = api_url
+        server.upstream.base_url = api_url
+    if http_port:
+        server.HTTP_PORT = http_port
+    if ws_port:
+        server.WS_PORT = ws_port
+    for override in overrides:
+        key, _, value = override.partition("=")
+        if not hasattr(server, key):
+            raise SystemExit(f"Unknown setting for {name}: {key}")
+        setattr(server, key, ast.literal_eval(value))
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="設定を上書きして vcSystem サーバーを起動します")
+    parser.add_argument("--server", default="index", help="起動するモジュール (index または a)")
+    parser.add_argument("--api-url")
+    parser.add_argument("--http-port", type=int)
+    parser.add_argument("--ws-port", type=int)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="モジュールの定数を上書きする (値は Python のリテラル)")
+    args = parser.parse_args()
+
+    server = load_server(args.server, args.api_url, args.http_port, args.ws_port, args.set)
+    try:
+        if hasattr(server, "run"):
+            server.run()  # index.py は CLUSTER_WORKERS に応じて1プロセス / マルチプロセスを選ぶ
+        else:
+            asyncio.run(server.main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import asyncio
+
+
+class CoalescedBroadcaster:
+    """
+    request() が何回呼ばれても、window 秒ごとに broadcast を 1 回だけ実行します。
+    """
+
+    def __init__(self, broadcast, window=0.1):
+        self.broadcast = broadcast
+        self.window = window
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def request(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            # ここから先に来た要求は次の window にまとめる
+            self.task = None
+        async with self.lock:
+            await self.broadcast()
+
+
+class UserListChanges:
+    """
+    クライアントごとに最後に送った userList を覚えておき、
+    近くのユーザーが入れ替わったときか、距離・音量がしきい値以上変わったときだけ送信を許可します。
+    """
+
+    def __init__(self, distance_threshold=0.5, volume_threshold=0.02):
+        self.distance_threshold = distance_threshold
+        self.volume_threshold = volume_threshold
+        self.last_sent = {}  # key -> {username: (distance, volume)}
+
+    def changed(self, key, users):
+        current = {user["username"]: (user["distance"], user.get("volume", 0.0)) for user in users}
+        previous = self.last_sent.get(key)
+        if previous is not None and previous.keys() == current.keys() and all(
+            abs(distance - previous[username][0]) < self.distance_threshold and
+            abs(volume - previous[username][1]) < self.volume_threshold
+            for username, (distance, volume) in current.items()
+        ):
+            return False
+        self.last_sent[key] = current
+        return True
+
+    def forget(self, key):
+        self.last_sent.pop(key, None)
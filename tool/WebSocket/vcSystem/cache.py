@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+
+class SingleFlightCache:
+    """
+    load() の結果を ttl 秒だけ覚えておくキャッシュです。
+    期限が切れたあとに同時に来た get() は 1 回の load() の結果を一緒に待つので、上流への問い合わせは重なりません。
+    load() が None を返すか例外を投げた場合は、最後に取得できた値をそのまま返します (取得できたことが無ければ None)。
+    失敗した場合も ttl 秒は問い合わせ直さないので、上流が落ちている間に問い合わせが集中しません。
+    """
+
+    def __init__(self, load, ttl):
+        self.load = load
+        self.ttl = ttl
+        self.value = None
+        self.loaded_at = None  # 最後に取得できた時刻
+        self.expires = 0.0  # この時刻までは問い合わせ直さない
+        self.inflight = None
+        self.stale = False  # 最後の取得に失敗して、古い値を返している
+        self.stats = {"hits": 0, "loads": 0, "coalesced": 0, "failures": 0, "stale_served": 0}
+
+    def age(self):
+        """最後に取得できてからの秒数を返します。取得できたことが無ければ None です。"""
+        return None if self.loaded_at is None else time.monotonic() - self.loaded_at
+
+    async def get(self):
+        if time.monotonic() < self.expires:
+            self.stats["hits"] += 1
+            if self.stale:
+                self.stats["stale_served"] += 1
+            return self.value
+        if self.inflight is None:
+            self.inflight = asyncio.ensure_future(self._load())
+        else:
+            self.stats["coalesced"] += 1
+        # 待っている側がキャンセルされても、他の get() が待っている問い合わせは止めない
+        return await asyncio.shield(self.inflight)
+
+    async def _load(self):
+        self.stats["loads"] += 1
+        try:
+            value = await self.load()
+        except Exception as error:
+            print("キャッシュする値の取得に失敗しました:", error)
+            value = None
+        finally:
+            self.inflight = None
+            self.expires = time.monotonic() + self.ttl
+        if value is None:
+            self.stats["failures"] += 1
+            if self.value is not None:
+                self.stale = True
+                self.stats["stale_served"] += 1
+            return self.value
+        self.value = value
+        self.stale = False
+        self.loaded_at = time.monotonic()
+        return value
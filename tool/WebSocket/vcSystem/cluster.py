@@ -0,0 +1,420 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import time
+from multiprocessing import shared_memory
+
+from container import ParsedChunk
+from protocol import DIMENSION_UNKNOWN
+
+# 共有メモリの先頭にワーカーごとの世代番号 (u32)、続けてワーカーごとの /ingest の最終受信時刻 (float64) を並べ、
+# その後ろに座標の行を並べます。行はワーカーごとに範囲を分けて持ち、書き込むのは持ち主のワーカーだけです。
+GENERATION = struct.Struct("<I")
+INGEST_SEEN = struct.Struct("<d")  # time.monotonic() の値。ストリームが無ければ 0
+SEQ = struct.Struct("<I")  # 行の先頭の seq だけを読み書きする
+ROW = struct.Struct("<IBxxxi3d48s")  # seq / 使用中 / dimension / x, y, z / username (UTF-8)
+MAX_USERNAME_BYTES = 48
+
+# ClusterWorker.claim の結果
+CLAIM_OK = "ok"
+CLAIM_FULL = "full"  # このワーカーの行が足りない
+CLAIM_NAME_TOO_LONG = "name_too_long"  # ユーザー名が MAX_USERNAME_BYTES を超える
+CLAIM_DUPLICATE = "duplicate"  # 他のワーカーに同じユーザー名が接続している
+
+# ワーカー間のフレーム: 種類 / 本体のバイト数 / ユーザー名の数、続けてユーザー名 (u8 長さ + UTF-8)、本体
+#   FORWARD_AUDIO: 本体は FORWARDED_AUDIO、受信者ごとの音量 (float32)、続けて初期化セグメント / resync / 音声。
+#                  ユーザー名は受信者。初期化セグメントの版が 0 なら WebM として解析できなかった音声で、音声の部分だけを使う
+#   FORWARD_POSITION: 本体は FORWARDED_POSITION、ユーザー名は座標の持ち主 (1つ)
+FORWARD_HEADER = struct.Struct(">BIH")
+FORWARD_AUDIO = 0
+FORWARD_POSITION = 1
+FORWARDED_AUDIO = struct.Struct(">HIII")  # 送信者ID / 初期化セグメントの版 / 初期化セグメントの長さ / resync の長さ
+GAIN = struct.Struct(">f")
+FORWARDED_POSITION = struct.Struct(">3dh")  # x, y, z / dimension (無ければ DIMENSION_UNKNOWN)
+
+
+class SharedPositionTable:
+    """
+    全ワーカーの接続ユーザーの座標を置く共有メモリの表です。
+    行ごとに seq を持ち、書き込み中は奇数にする (seqlock) ので、読む側はロックなしで読めます。
+    ユーザー名を新しく行に書くときだけは claim_lock を取り、同じ名前を2つのワーカーが同時に使えないようにします。
+    """
+
+    def __init__(self, shm, workers, rows_per_worker, claim_lock):
+        self.shm = shm
+        self.claim_lock = claim_lock
+        self.workers = workers
+        self.rows_per_worker = rows_per_worker
+        self.buffer = shm.buf
+        self.ingest_offset = GENERATION.size * workers
+        self.rows_offset = self.ingest_offset + INGEST_SEEN.size * workers
+
+    @staticmethod
+    def size(workers, rows_per_worker):
+        return (GENERATION.size + INGEST_SEEN.size) * workers + ROW.size * workers * rows_per_worker
+
+    @classmethod
+    def create(cls, workers, rows_per_worker):
+        shm = shared_memory.SharedMemory(create=True, size=cls.size(workers, rows_per_worker))
+        shm.buf[:] = bytes(shm.size)
+        return cls(shm, workers, rows_per_worker, multiprocessing.get_context("fork").Lock())
+
+    def generation(self, worker):
+        return GENERATION.unpack_from(self.buffer, GENERATION.size * worker)[0]
+
+    def _bump_generation(self, worker):
+        offset = GENERATION.size * worker
+        GENERATION.pack_into(self.buffer, offset, (self.generation(worker) + 1) & 0xFFFFFFFF)
+
+    def ingest_seen(self, worker):
+        return INGEST_SEEN.unpack_from(self.buffer, self.ingest_offset + INGEST_SEEN.size * worker)[0]
+
+    def set_ingest_seen(self, worker, timestamp):
+        INGEST_SEEN.pack_into(self.buffer, self.ingest_offset + INGEST_SEEN.size * worker, timestamp)
+
+    def _row_offset(self, row):
+        return self.rows_offset + ROW.size * row
+
+    def _write_row(self, worker, row, in_use, dimension, x, y, z, name):
+        offset = self._row_offset(row)
+        seq = SEQ.unpack_from(self.buffer, offset)[0]
+        # 先に行を組み立てておき、pack に失敗しても seq が奇数のまま残らないようにする
+        data = ROW.pack((seq + 1) & 0xFFFFFFFF, in_use, dimension, x, y, z, name)
+        SEQ.pack_into(self.buffer, offset, (seq + 1) & 0xFFFFFFFF)  # 書き込み中 (奇数)
+        self.buffer[offset:offset + ROW.size] = data
+        SEQ.pack_into(self.buffer, offset, (seq + 2) & 0xFFFFFFFF)
+        self._bump_generation(worker)
+
+    def write(self, worker, row, username, position, dimension):
+        self._write_row(worker, row, 1, dimension, position["x"], position["y"], position["z"], username.encode())
+
+    def clear(self, worker, row):
+        self._write_row(worker, row, 0, 0, 0.0, 0.0, 0.0, b"")
+
+    def read_worker(self, worker):
+        """worker が持つ行のうち使用中のものを {username: (row, position, dimension)} で返します。"""
+        users = {}
+        first = worker * self.rows_per_worker
+        for row in range(first, first + self.rows_per_worker):
+            offset = self._row_offset(row)
+            for _ in range(100):
+                seq, in_use, dimension, x, y, z, name = ROW.unpack_from(self.buffer, offset)
+                if seq % 2 == 0 and SEQ.unpack_from(self.buffer, offset)[0] == seq:
+                    break
+            else:
+                continue  # 書き込み途中のまま読めない行は次の sync で読む
+            if in_use:
+                users[name.rstrip(b"\0").decode()] = (row, {"x": x, "y": y, "z": z}, dimension)
+        return users
+
+    def close(self):
+        self.buffer = None
+        self.shm.close()
+
+
+class ClusterWorker:
+    """
+    マルチプロセス時にワーカー1つが持つ状態です。
+    自分の接続ユーザーの座標を共有メモリに書き、他のワーカーのユーザーの座標を読み取り、
+    他のワーカーにいる受信者への音声は Unix ソケットで持ち主のワーカーへ送ります。
+    """
+
+    def __init__(self, table, worker_id, socket_dir, max_forward_buffer=1024 * 1024):
+        self.table = table
+        self.worker_id = worker_id
+        self.socket_dir = socket_dir
+        self.max_forward_buffer = max_forward_buffer  # 送り先ワーカーへの未送信バイト数の上限 (超えたら音声を捨てる)
+        self.rows = {}  # 自分のユーザー名 -> 行番号
+        first = worker_id * table.rows_per_worker
+        self.free_rows = list(range(first + table.rows_per_worker - 1, first - 1, -1))
+        self.remote_users = {}  # 他のワーカーのユーザー名 -> (worker, row, position, dimension)
+        self.generations = {}  # worker -> 最後に読んだ世代番号
+        self.peers = {}  # worker -> StreamWriter
+        self.connecting = {}  # worker -> 接続中の Lock (同じワーカーへ二重に接続しない)
+        self.pending = set()  # 接続を待ってから座標を送るタスク
+        self.server = None
+        self.incoming = {}  # 他のワーカーからの接続の StreamWriter -> 受信タスク
+        self.on_audio = None
+        self.on_position = None
+        self.stats = {
+            "frames_forwarded": 0, "frames_received": 0, "frames_dropped": 0,
+            "positions_forwarded": 0, "positions_received": 0,
+        }
+
+    def socket_path(self, worker):
+        return os.path.join(self.socket_dir, f"worker-{worker}.sock")
+
+    async def start(self, on_audio, on_position):
+        """
+        on_audio(listeners, sender_id, audio_data, chunk) は他のワーカーから音声が届いたときに呼ばれます。
+        listeners は (ユーザー名, 音量) のリスト、chunk は WebM として解析できた音声なら ParsedChunk (できなければ None) です。
+        on_position(username, position, dimension) は他のワーカーの /ingest から座標が届いたときに呼ばれます。
+        """
+        self.on_audio = on_audio
+        self.on_position = on_position
+        self.server = await asyncio.start_unix_server(self._handle_peer, self.socket_path(self.worker_id))
+
+    async def close(self):
+        for writer in self.peers.values():
+            writer.close()
+        self.peers.clear()
+        if self.server is not None:
+            self.server.close()
+        # 受信タスクが終了中のループでキャンセルされないよう、接続を閉じて終わるのを待つ
+        for writer in self.incoming:
+            writer.close()
+        await asyncio.gather(*self.incoming.values(), return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        for row in list(self.rows.values()):
+            self.table.clear(self.worker_id, row)
+        self.rows.clear()
+
+    def owner_of(self, username):
+        """username が接続しているワーカーの番号を返します。どこにも接続していなければ None です。"""
+        if username in self.rows:
+            return self.worker_id
+        remote = self.remote_users.get(username)
+        return remote[0] if remote else None
+
+    def session_id(self, username):
+        """共有メモリの行番号 + 1 をワーカーをまたいで一意なセッションIDとして返します。"""
+        row = self.rows.get(username)
+        if row is None:
+            remote = self.remote_users.get(username)
+            if remote is None:
+                return 0
+            row = remote[1]
+        return row + 1
+
+    def claim(self, username, position, dimension):
+        """
+        新しく接続したユーザーに行を割り当てて座標を書き、CLAIM_* のどれかを返します。
+        他のワーカーの行を確かめてから書くまでを claim_lock の中で行うので、同じ名前は1つのワーカーにしか入れません。
+        """
+        if len(username.encode()) > MAX_USERNAME_BYTES:
+            return CLAIM_NAME_TOO_LONG
+        if username in self.rows:
+            return CLAIM_DUPLICATE
+        if not self.free_rows:
+            return CLAIM_FULL
+        with self.table.claim_lock:
+            for worker in range(self.table.workers):
+                if worker != self.worker_id and username in self.table.read_worker(worker):
+                    return CLAIM_DUPLICATE
+            row = self.rows[username] = self.free_rows.pop()
+            self.table.write(self.worker_id, row, username, position, dimension)
+        return CLAIM_OK
+
+    def publish(self, username, position, dimension):
+        """claim したユーザーの座標を共有メモリに書きます。claim していないユーザーなら False を返します。"""
+        row = self.rows.get(username)
+        if row is None:
+            return False
+        self.table.write(self.worker_id, row, username, position, dimension)
+        return True
+
+    def withdraw(self, username):
+        row = self.rows.pop(username, None)
+        if row is not None:
+            self.table.clear(self.worker_id, row)
+            self.free_rows.append(row)
+
+    def report_ingest(self, last_received):
+        """このワーカーの /ingest が最後に受け取った時刻 (time.monotonic()、ストリームが無ければ 0) を共有します。"""
+        self.table.set_ingest_seen(self.worker_id, last_received)
+
+    def ingest_healthy(self, stale_after):
+        """他のワーカーのどれかで /ingest のストリームが生きていれば True を返します。"""
+        now = time.monotonic()
+        return any(
+            now - self.table.ingest_seen(worker) < stale_after
+            for worker in range(self.table.workers)
+            if worker != self.worker_id
+        )
+
+    def sync(self):
+        """
+        他のワーカーの行を読み、前回から変わったユーザーと居なくなったユーザーを返します。
+        世代番号が変わっていないワーカーの行は読みません。
+        """
+        updated = []
+        removed = []
+        for worker in range(self.table.workers):
+            if worker == self.worker_id:
+                continue
+            generation = self.table.generation(worker)
+            if self.generations.get(worker) == generation:
+                continue
+            self.generations[worker] = generation
+            users = self.table.read_worker(worker)
+            for username, (row, position, dimension) in users.items():
+                previous = self.remote_users.get(username)
+                if previous != (worker, row, position, dimension):
+                    self.remote_users[username] = (worker, row, position, dimension)
+                    updated.append((username, position, dimension))
+            for username, (owner, _, _, _) in list(self.remote_users.items()):
+                if owner == worker and username not in users:
+                    del self.remote_users[username]
+                    removed.append(username)
+        return updated, removed
+
+    async def _peer(self, worker):
+        """worker への接続を返します。まだ無ければつなぎ、つなげなければ None を返します。"""
+        writer = self.peers.get(worker)
+        if writer is None or writer.is_closing():
+            async with self.connecting.setdefault(worker, asyncio.Lock()):
+                writer = self.peers.get(worker)
+                if writer is None or writer.is_closing():
+                    try:
+                        _, writer = await asyncio.open_unix_connection(self.socket_path(worker))
+                    except OSError:
+                        return None
+                    self.peers[worker] = writer
+        return writer
+
+    @staticmethod
+    def _frame(kind, usernames, body):
+        names = [name.encode() for name in usernames]
+        parts = [FORWARD_HEADER.pack(kind, len(body), len(names))]
+        for name in names:
+            parts.append(bytes((len(name),)))
+            parts.append(name)
+        parts.append(body)
+        return b"".join(parts)
+
+    async def forward(self, worker, listeners, sender_id, audio_data, chunk=None):
+        """
+        他のワーカーにいる受信者 listeners ((ユーザー名, 音量) のリスト) へ音声を送ります。送れなかったフレームは捨てます。
+        chunk があれば解析した結果のまま送り、受信者ごとのフレームは持ち主のワーカーで組み立ててもらいます。
+        """
+        writer = await self._peer(worker)
+        if writer is None or writer.transport.get_write_buffer_size() > self.max_forward_buffer:
+            self.stats["frames_dropped"] += 1
+            return
+        if chunk is None:
+            parts = (FORWARDED_AUDIO.pack(sender_id, 0, 0, 0), audio_data)
+        else:
+            parts = (
+                FORWARDED_AUDIO.pack(sender_id, chunk.init_version, len(chunk.init), len(chunk.resync)),
+                chunk.init, chunk.resync, chunk.media,
+            )
+        gains = b"".join(GAIN.pack(volume) for _, volume in listeners)
+        body = parts[0] + gains + b"".join(parts[1:])
+        writer.write(self._frame(FORWARD_AUDIO, [username for username, _ in listeners], body))
+        self.stats["frames_forwarded"] += 1
+
+    def forward_position(self, worker, username, position, dimension):
+        """
+        /ingest に届いた他のワーカーのユーザーの座標を持ち主の worker へ送ります。
+        座標は共有メモリの持ち主しか書けないので、持ち主の set_user_position を通して反映してもらいます。
+        """
+        frame = self._frame(FORWARD_POSITION, [username], FORWARDED_POSITION.pack(
+            position["x"], position["y"], position["z"],
+            DIMENSION_UNKNOWN if dimension is None else dimension,
+        ))
+        writer = self.peers.get(worker)
+        if writer is not None and not writer.is_closing():
+            writer.write(frame)
+            self.stats["positions_forwarded"] += 1
+        else:
+            task = asyncio.create_task(self._forward_position(worker, frame))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+
+    async def _forward_position(self, worker, frame):
+        writer = await self._peer(worker)
+        if writer is None:
+            self.stats["frames_dropped"] += 1
+            return
+        writer.write(frame)
+        self.stats["positions_forwarded"] += 1
+
+    async def _handle_peer(self, reader, writer):
+        self.incoming[writer] = asyncio.current_task()
+        try:
+            while True:
+                kind, size, count = FORWARD_HEADER.unpack(await reader.readexactly(FORWARD_HEADER.size))
+                usernames = []
+                for _ in range(count):
+                    length = (await reader.readexactly(1))[0]
+                    usernames.append((await reader.readexactly(length)).decode())
+                body = await reader.readexactly(size)
+                if kind == FORWARD_POSITION:
+                    x, y, z, dimension = FORWARDED_POSITION.unpack(body)
+                    self.stats["positions_received"] += 1
+                    self.on_position(
+                        usernames[0], {"x": x, "y": y, "z": z}, None if dimension == DIMENSION_UNKNOWN else dimension,
+                    )
+                else:
+                    self.stats["frames_received"] += 1
+                    self._receive_audio(usernames, body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.incoming.pop(writer, None)
+            writer.close()
+
+
+    def _receive_audio(self, usernames, body):
+        sender_id, init_version, init_length, resync_length = FORWARDED_AUDIO.unpack_from(body)
+        offset = FORWARDED_AUDIO.size
+        listeners = []
+        for username in usernames:
+            listeners.append((username, GAIN.unpack_from(body, offset)[0]))
+            offset += GAIN.size
+        if init_version == 0:
+            self.on_audio(listeners, sender_id, body[offset:], None)
+            return
+        init = body[offset:offset + init_length]
+        offset += init_length
+        resync = body[offset:offset + resync_length]
+        chunk = ParsedChunk(init, init_version, resync, body[offset + resync_length:])
+        self.on_audio(listeners, sender_id, chunk.standalone(), chunk)
+
+
+def _run_worker(worker_main, table, worker_id, socket_dir):
+    worker = ClusterWorker(table, worker_id, socket_dir)
+    try:
+        asyncio.run(worker_main(worker))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        table.close()
+
+
+def run_workers(worker_main, workers, rows_per_worker):
+    """
+    共有メモリの表を作ってから workers 個のプロセスを fork し、それぞれで worker_main(ClusterWorker) を動かします。
+    ポートは各ワーカーが SO_REUSEPORT で共有するので、接続はカーネルがワーカーに振り分けます (Linux 専用)。
+    """
+    table = SharedPositionTable.create(workers, rows_per_worker)
+    socket_dir = tempfile.mkdtemp(prefix="vcsystem-")
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_run_worker, args=(worker_main, table, worker_id, socket_dir), daemon=True)
+        for worker_id in range(workers)
+    ]
+    try:
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # 親だけが SIGINT を受けた場合も、各ワーカーに後片付けをさせてから終わる
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join(5)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        table.close()
+        table.shm.unlink()
+        shutil.rmtree(socket_dir, ignore_errors=True)
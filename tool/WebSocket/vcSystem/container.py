@@ -0,0 +1,300 @@
+import itertools
+
+from framing import FRAME_KIND_INIT, FRAME_KIND_MEDIA, audio_frame
+
+# WebM (Matroska / EBML) の要素 ID (先頭のマーカービットを含めたまま比較する)
+EBML_ID = 0x1A45DFA3
+SEGMENT_ID = 0x18538067
+CLUSTER_ID = 0x1F43B675
+TIMECODE_ID = 0xE7
+SIMPLE_BLOCK_ID = 0xA3
+BLOCK_GROUP_ID = 0xA0
+INFO_ID = 0x1549A966
+TRACKS_ID = 0x1654AE6B
+# サイズ不明のクラスターはこれらの要素が現れたところで終わる
+SEGMENT_LEVEL_IDS = {
+    EBML_ID, SEGMENT_ID, CLUSTER_ID,
+    0x114D9B74,  # SeekHead
+    INFO_ID, TRACKS_ID,
+    0x1C53BB6B,  # Cues
+    0x1043A770,  # Chapters
+    0x1941A469,  # Attachments
+    0x1254C367,  # Tags
+}
+
+EBML_MAGIC = EBML_ID.to_bytes(4, "big")
+UNKNOWN_SIZE = -1
+# 受信者に送るクラスターの先頭。サイズは「不明」にしておくので、途中のブロックを間引いても壊れない
+CLUSTER_START = CLUSTER_ID.to_bytes(4, "big") + b"\x01\xff\xff\xff\xff\xff\xff\xff"
+# Segment も同じで、中身を間引くとサイズが合わなくなるので「不明」にしておく
+SEGMENT_START = SEGMENT_ID.to_bytes(4, "big") + b"\x01\xff\xff\xff\xff\xff\xff\xff"
+MAX_PENDING_BYTES = 1024 * 1024  # 1つの要素がこれより大きくなったら壊れたストリームとみなす
+
+OGG_MAGIC = b"OggS"
+
+_init_versions = itertools.count(1)  # 初期化セグメントの版。話者をまたいで一意にする
+
+
+class NeedMoreData(Exception):
+    pass
+
+
+class StreamError(Exception):
+    pass
+
+
+def read_element_id(data, pos):
+    """pos から要素 ID を読み (ID, バイト数) を返します。"""
+    if pos >= len(data):
+        raise NeedMoreData
+    first = data[pos]
+    length = 9 - first.bit_length()
+    if first == 0 or length > 4:
+        raise StreamError("invalid element id")
+    if pos + length > len(data):
+        raise NeedMoreData
+    return int.from_bytes(data[pos:pos + length], "big"), length
+
+
+def read_element_size(data, pos):
+    """pos から要素のサイズを読み (サイズ, バイト数) を返します。サイズ不明の場合は UNKNOWN_SIZE です。"""
+    if pos >= len(data):
+        raise NeedMoreData
+    first = data[pos]
+    if first == 0:
+        raise StreamError("invalid element size")
+    length = 9 - first.bit_length()
+    if pos + length > len(data):
+        raise NeedMoreData
+    value = int.from_bytes(data[pos:pos + length], "big") & ((1 << (7 * length)) - 1)
+    if value == (1 << (7 * length)) - 1:
+        return UNKNOWN_SIZE, length
+    return value, length
+
+
+def ogg_header_length(data):
+    """
+    Ogg Opus の先頭のヘッダーページ (OpusHead / OpusTags、グラニュール位置が 0 のページ) の長さを返します。
+    ページを読み切れない場合は None です。
+    """
+    pos = 0
+    while len(data) >= pos + 27 and data[pos:pos + 4] == OGG_MAGIC:
+        segments = data[pos + 26]
+        if len(data) < pos + 27 + segments:
+            return None
+        page_end = pos + 27 + segments + sum(data[pos + 27:pos + 27 + segments])
+        if page_end > len(data):
+            return None
+        if int.from_bytes(data[pos + 6:pos + 14], "little") != 0:
+            break
+        pos = page_end
+    return pos or None
+
+
+class ParsedChunk:
+    """
+    話者のチャンク1つを解析した結果です。
+    media はこのチャンクで読み切れた要素 (クラスターの先頭とブロック)、
+    resync は media がクラスターの途中から始まるときに先頭に補うクラスターの先頭です。
+    """
+
+    __slots__ = ("init", "init_version", "resync", "media", "_standalone")
+
+    def __init__(self, init, init_version, resync, media):
+        self.init = init
+        self.init_version = init_version
+        self.resync = resync
+        self.media = media
+        self._standalone = None
+
+    def standalone(self):
+        """初期化セグメントを付けて、単独でデコードできる WebM にしたものを返します (1回だけ組み立てる)。"""
+        if self._standalone is None:
+            self._standalone = self.init + self.resync + self.media
+        return self._standalone
+
+
+class WebMStreamParser:
+    """
+    話者1人分の WebM を少しずつ読む解析器です。チャンクの境目が要素の途中にあってもよく、
+    読み切れなかった分は次のチャンクとつなげて読みます。
+    先頭の EBML ヘッダーから最初のクラスターの前までを初期化セグメントとして取っておき、
+    それ以降はクラスターの先頭 (Timecode まで) とブロックだけを取り出します。
+    チャンクが EBML ヘッダーで始まっていれば、新しいストリームとして読み直します。
+    """
+
+    def __init__(self):
+        self.init = None  # 初期化セグメント (最初のクラスターが来るまでは None)
+        self.init_version = 0
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.state = "header"  # header / segment / cluster / lost
+        self.init_parts = []
+        self.cluster_remaining = None  # サイズが分かっているクラスターの残りバイト数
+        self.cluster_start = None  # 今のクラスターの先頭 (CLUSTER_START + Timecode)
+
+    def feed(self, data):
+        """チャンクを読み、ParsedChunk を返します。WebM として読めない場合は None です。"""
+        if data[:4] == EBML_MAGIC:
+            self.reset()
+        elif self.state == "lost":
+            return None
+        resync = self.cluster_start
+        self.buffer += data
+        elements = []
+        pos = 0
+        try:
+            while True:
+                pos = self._step(pos, elements)
+        except NeedMoreData:
+            pass
+        except StreamError:
+            self.state = "lost"
+            self.buffer = bytearray()
+            return None
+        del self.buffer[:pos]
+        if len(self.buffer) > MAX_PENDING_BYTES:
+            self.state = "lost"
+            self.buffer = bytearray()
+            return None
+        if self.init is None:
+            return None
+        if elements and elements[0][0] == "cluster":
+            resync = None
+        return ParsedChunk(self.init, self.init_version, resync or b"", b"".join(data for _, data in elements))
+
+    def _element(self, pos, need_body=True):
+        """pos の要素の (ID, ヘッダーの長さ, 本体の長さ) を返します。need_body なら本体が揃うまで待ちます。"""
+        element_id, id_length = read_element_id(self.buffer, pos)
+        size, size_length = read_element_size(self.buffer, pos + id_length)
+        header_length = id_length + size_length
+        if need_body:
+            if size == UNKNOWN_SIZE:
+                raise StreamError("unknown-sized element")
+            if pos + header_length + size > len(self.buffer):
+                raise NeedMoreData
+        return element_id, header_length, size
+
+    def _step(self, pos, elements):
+        """要素を1つ読み、次に読む位置を返します。"""
+        if self.state == "header":
+            element_id, header_length, size = self._element(pos)
+            if element_id != EBML_ID:
+                raise StreamError("missing EBML header")
+            end = pos + header_length + size
+            self.init_parts = [bytes(self.buffer[pos:end])]
+            self.state = "segment_header"
+            return end
+
+        if self.state == "segment_header":
+            element_id, header_length, _ = self._element(pos, need_body=False)
+            if element_id != SEGMENT_ID:
+                raise StreamError("missing Segment")
+            self.init_parts.append(SEGMENT_START)
+            self.state = "segment"
+            return pos + header_length
+
+        if self.state == "segment":
+            element_id, header_length, size = self._element(pos, need_body=False)
+            if element_id == EBML_ID:
+                # 同じチャンクの途中から次のストリームが始まった
+                del self.buffer[:pos]
+                self.state = "header"
+                self.cluster_start = None
+                return 0
+            if element_id == CLUSTER_ID:
+                if self._init_pending():
+                    self._publish_init()
+                self.cluster_remaining = None if size == UNKNOWN_SIZE else size
+                self.cluster_start = None
+                self.state = "cluster"
+                return pos + header_length
+            element_id, header_length, size = self._element(pos)
+            end = pos + header_length + size
+            # 初期化セグメントには Info / Tracks だけを入れる。
+            # SeekHead / Cues はバイト位置を持っていて、間引いたストリームでは合わないので送らない
+            if self._init_pending() and element_id in (INFO_ID, TRACKS_ID):
+                self.init_parts.append(bytes(self.buffer[pos:end]))
+            return end
+
+        # cluster
+        if self.cluster_remaining == 0:
+            self.state = "segment"
+            return pos
+        element_id, header_length, size = self._element(pos, need_body=False)
+        if element_id in SEGMENT_LEVEL_IDS:
+            self.state = "segment"
+            return pos
+        element_id, header_length, size = self._element(pos)
+        end = pos + header_length + size
+        if self.cluster_remaining is not None:
+            self.cluster_remaining = max(0, self.cluster_remaining - (end - pos))
+        if element_id == TIMECODE_ID:
+            self.cluster_start = CLUSTER_START + bytes(self.buffer[pos:end])
+            elements.append(("cluster", self.cluster_start))
+        elif element_id in (SIMPLE_BLOCK_ID, BLOCK_GROUP_ID) and self.cluster_start is not None:
+            elements.append(("block", bytes(self.buffer[pos:end])))
+        return end
+
+    def _init_pending(self):
+        return bool(self.init_parts)
+
+    def _publish_init(self):
+        init = b"".join(self.init_parts)
+        self.init_parts = []
+        if init != self.init:
+            # MediaRecorder を作り直しただけで中身が同じなら、受信者に送り直さない
+            self.init = init
+            self.init_version = next(_init_versions)
+
+
+class SpeakerStreams:
+    """話者ごとの WebMStreamParser をまとめて持ちます。"""
+
+    def __init__(self):
+        self.parsers = {}  # username -> WebMStreamParser
+        self.stats = {"chunks_parsed": 0, "chunks_unparsed": 0, "headers_stripped": 0}
+
+    def push(self, username, data):
+        """話者のチャンクを読み、ParsedChunk を返します。WebM として読めない場合は None です。"""
+        parser = self.parsers.get(username)
+        if parser is None:
+            parser = self.parsers[username] = WebMStreamParser()
+        chunk = parser.feed(data)
+        if chunk is None:
+            self.stats["chunks_unparsed"] += 1
+        else:
+            self.stats["chunks_parsed"] += 1
+            if data[:4] == EBML_MAGIC:
+                self.stats["headers_stripped"] += 1
+        return chunk
+
+    def forget(self, username):
+        self.parsers.pop(username, None)
+
+
+class ListenerStreams:
+    """受信者1人分の、話者 (送信者ID) ごとに送った初期化セグメントの版を覚えておきます。"""
+
+    def __init__(self):
+        self.init_versions = {}  # 送信者ID -> 送った初期化セグメントの版
+
+    def frames(self, sender_id, gain, chunk):
+        """
+        chunk を送るためのフレームを (フレーム, 初期化セグメントか) のリストで返します。
+        まだ初期化セグメントを送っていない話者 (または初期化セグメントが変わった話者) なら先に送り、
+        クラスターの途中から聞き始める場合はクラスターの先頭を補います。
+        """
+        if not chunk.media:
+            return []
+        frames = []
+        payload = chunk.media
+        if self.init_versions.get(sender_id) != chunk.init_version:
+            self.init_versions[sender_id] = chunk.init_version
+            frames.append((audio_frame(sender_id, gain, chunk.init, FRAME_KIND_INIT), True))
+            if chunk.resync:
+                payload = chunk.resync + chunk.media
+        frames.append((audio_frame(sender_id, gain, payload, FRAME_KIND_MEDIA), False))
+        return frames
@@ -0,0 +1,115 @@
+import asyncio
+import math
+
+import numpy as np
+
+import audio_codec
+
+
+def quantize_gain(gain, step_db):
+    """音量を step_db (dB) 刻みに丸めます。受信者ごとの細かな音量の違いをまとめて、同じ処理結果を使い回すためです。"""
+    if gain <= 0:
+        return 0.0
+    if gain >= 1.0:
+        return 1.0
+    return 10 ** (round(20 * math.log10(gain) / step_db) * step_db / 20)
+
+
+def apply_gains(data, gains, bitrate=64000):
+    """
+    data を1回だけデコードし、gains のそれぞれの音量を掛けて元と同じコンテナにエンコードし直したものをリストで返します。
+    デコードできなかった場合は None を返します。executor (プロセスでもよい) 上で実行します。
+    """
+    pcm = audio_codec.decode_audio(data)
+    if pcm is None:
+        return None
+    container_format = "ogg" if data[:4] == b"OggS" else "webm"
+    return [
+        data if gain == 1.0 else audio_codec.encode_audio(np.clip(pcm * gain, -1.0, 1.0), bitrate, container_format)
+        for gain in gains
+    ]
+
+
+class GainProcessor:
+    """
+    受信者ごとの音量に調整した音声を executor 上で作ります。
+    音量は step_db 刻みに丸め、1つの音声につき丸めた音量ごとに1回だけデコード・エンコードします。
+    PyAV が無い場合やデコードできない音声は、音量を掛けずにそのまま返します (音量は再生側で掛けてもらう)。
+    """
+
+    def __init__(self, executor, step_db=3.0, bitrate=64000):
+        self.executor = executor
+        self.step_db = step_db
+        self.bitrate = bitrate
+        self.stats = {"frames": 0, "encodes": 0, "deliveries": 0, "passthrough": 0, "failures": 0}
+
+    async def apply(self, data, gains):
+        """
+        gains の順に (音声, 音量を掛けたか) のリストを返します。音量が 0 に丸められた受信者は None です。
+        音量を掛けられなかった受信者には data をそのまま返すので、音量は呼び出し側でヘッダーに入れてください。
+        """
+        quantized = [quantize_gain(gain, self.step_db) for gain in gains]
+        buckets = sorted({gain for gain in quantized if 0 < gain < 1.0})
+        self.stats["frames"] += 1
+        self.stats["deliveries"] += sum(1 for gain in quantized if gain > 0)
+
+        processed = None
+        if buckets and audio_codec.available:
+            loop = asyncio.get_running_loop()
+            try:
+                processed = await loop.run_in_executor(self.executor, apply_gains, data, buckets, self.bitrate)
+            except Exception as error:
+                print("音量の調整に失敗しました:", error)
+            if processed is None:
+                self.stats["failures"] += 1
+            else:
+                self.stats["encodes"] += len(buckets)
+        by_gain = {1.0: data}  # 音量 1.0 はそのままで掛けたのと同じ
+        if processed is not None:
+            by_gain.update(zip(buckets, processed))
+        elif buckets:
+            self.stats["passthrough"] += 1
+        return [
+            None if gain == 0 else (by_gain[gain], True) if gain in by_gain else (data, False)
+            for gain in quantized
+        ]
+
+
+def encode_bitrates(data, bitrates):
+    """
+    data を1回だけデコードし、bitrates のそれぞれのビットレートでエンコードし直したものをリストで返します。
+    デコードできなかった場合は None を返します。executor (プロセスでもよい) 上で実行します。
+    """
+    pcm = audio_codec.decode_audio(data)
+    if pcm is None:
+        return None
+    container_format = "ogg" if data[:4] == b"OggS" else "webm"
+    return [audio_codec.encode_audio(pcm, bitrate, container_format) for bitrate in bitrates]
+
+
+class TierTranscoder:
+    """
+    話者の音声を、受信者の距離の段ごとに決めたビットレートで executor 上でエンコードし直します。
+    1つの音声につきビットレートごとに1回だけエンコードし、同じ段の受信者全員で共有します。
+    """
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.stats = {"frames": 0, "encodes": 0, "failures": 0}
+
+    async def apply(self, data, bitrates):
+        """{ビットレート: エンコードし直した音声} を返します。PyAV が無い場合やエンコードできなかった場合は空です。"""
+        if not bitrates or not audio_codec.available:
+            return {}
+        self.stats["frames"] += 1
+        loop = asyncio.get_running_loop()
+        try:
+            encoded = await loop.run_in_executor(self.executor, encode_bitrates, data, bitrates)
+        except Exception as error:
+            print("ビットレートの変換に失敗しました:", error)
+            encoded = None
+        if encoded is None:
+            self.stats["failures"] += 1
+            return {}
+        self.stats["encodes"] += len(bitrates)
+        return dict(zip(bitrates, encoded))
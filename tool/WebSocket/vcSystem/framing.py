@@ -0,0 +1,24 @@
+import struct
+
+# 転送する音声の先頭に付けるヘッダー
+#   magic "VC" (2バイト) / version (1) / kind (1) / 送信者ID (uint16) / 音量 (float32)
+# 数値はすべてビッグエンディアン。ペイロード (話者が送った音声そのもの) はこの後ろに続く
+AUDIO_HEADER = struct.Struct(">2sBBHf")
+AUDIO_HEADER_MAGIC = b"VC"
+AUDIO_HEADER_VERSION = 1
+
+FRAME_KIND_AUDIO = 0  # 単独でデコードできる音声 (話者が送ったまま、またはサーバーで組み立てたもの)
+FRAME_KIND_INIT = 1  # 話者のストリームの初期化セグメント (WebM の EBML ヘッダー / Info / Tracks)
+FRAME_KIND_MEDIA = 2  # 初期化セグメントの後ろにつなげるクラスターとブロック
+
+
+def pack_audio_header(sender_id, gain, kind=FRAME_KIND_AUDIO):
+    return AUDIO_HEADER.pack(AUDIO_HEADER_MAGIC, AUDIO_HEADER_VERSION, kind, sender_id, gain)
+
+
+def audio_frame(sender_id, gain, payload, kind=FRAME_KIND_AUDIO):
+    """
+    ヘッダーとペイロードを別々の断片として返します。
+    websocket.send() に渡すと 1 つのメッセージとして送られるので、ペイロードを受信者ごとにコピーせずに済みます。
+    """
+    return (pack_audio_header(sender_id, gain, kind), payload)
@@ -0,0 +1,135 @@
+import hmac
+import ipaddress
+import json
+import time
+
+from aiohttp import WSMsgType, web
+
+from protocol import is_valid_position, parse_dimension
+
+
+class PositionIngest:
+    """
+    ゲーム側のブリッジから座標を押し込んでもらう /ingest エンドポイントです。
+    WebSocket (1メッセージ = 1つの JSON) と、チャンク転送の POST (1行 = 1つの JSON, NDJSON) を受け付けます。
+
+    JSON は {"name", "position": {"x", "y", "z"}, "dimension"} か、そのリスト。
+    {"type": "heartbeat"} は座標を含まず、ストリームが生きていることだけを伝えます。
+    ブリッジは接続直後に全員分を送り、その後は動いたプレイヤーの分だけ送ればよく、
+    一度でも座標が届いたユーザーはストリームが止まるまでポーリングの対象から外れます。
+    token が無い場合は、同じマシン (ループバック) からの接続だけを受け付けます。
+
+    マルチプロセス時はブリッジの接続が1つのワーカーにしか届かないので、他のワーカーのユーザーの座標は
+    持ち主のワーカーへ転送され (cover_forwarded)、ストリームが生きているかは peer_healthy で確かめます。
+    """
+
+    def __init__(self, apply, stale_after=3.0, token=None):
+        self.apply = apply  # apply(username, position, dimension)
+        self.stale_after = stale_after  # この秒数なにも届かなければストリームが止まったとみなす
+        self.token = token
+        self.streams = 0
+        self.last_received = 0.0
+        self.covered = set()  # 今のストリームで座標が届いたユーザー名
+        self.forwarded = set()  # 他のワーカーの /ingest から座標が転送されてきたユーザー名
+        self.peer_healthy = None  # マルチプロセス時に、他のワーカーのストリームが生きていれば True を返す関数
+        self.stats = {"updates": 0, "invalid": 0, "streams_opened": 0}
+
+    def healthy(self):
+        return self.streams > 0 and time.monotonic() - self.last_received < self.stale_after
+
+    def covers(self, username):
+        """username の座標をストリームから受け取れているなら True (ポーリング不要) を返します。"""
+        if username in self.covered and self.healthy():
+            return True
+        return username in self.forwarded and self.peer_healthy is not None and self.peer_healthy()
+
+    def cover_forwarded(self, username):
+        """他のワーカーの /ingest から username の座標が転送されてきたことを記録します。"""
+        self.forwarded.add(username)
+
+    def _authorized(self, request):
+        if self.token is None:
+            # トークンが無ければ同じマシンのブリッジからだけ受け付ける (誰でも他人の座標を動かせないようにする)
+            try:
+                return ipaddress.ip_address(request.transport.get_extra_info("peername")[0]).is_loopback
+            except (AttributeError, TypeError, ValueError):
+                return False
+        header = request.headers.get("Authorization", "")
+        supplied = header[len("Bearer "):] if header.startswith("Bearer ") else request.query.get("token", "")
+        return hmac.compare_digest(supplied.encode(), self.token.encode())
+
+    def _open(self):
+        if self.streams == 0:
+            self.covered.clear()
+        self.streams += 1
+        self.stats["streams_opened"] += 1
+        self.last_received = time.monotonic()
+
+    def _close(self):
+        self.streams -= 1
+        if self.streams == 0:
+            self.covered.clear()
+
+    def receive(self, text):
+        """JSON 1つ分を処理し、反映した座標の数を返します。"""
+        self.last_received = time.monotonic()
+        try:
+            data = json.loads(text)
+        except json.JSONDecodeError:
+            self.stats["invalid"] += 1
+            return 0
+        updates = data if isinstance(data, list) else [data]
+        applied = 0
+        for update in updates:
+            if not isinstance(update, dict) or update.get("type") == "heartbeat":
+                continue
+            username = update.get("name")
+            position = update.get("position")
+            dimension = update.get("dimension")
+            if isinstance(username, str) and is_valid_position(position):
+                self.covered.add(username)
+                self.apply(username, position, parse_dimension(dimension))
+                applied += 1
+            else:
+                self.stats["invalid"] += 1
+        self.stats["updates"] += applied
+        return applied
+
+    async def handle(self, request):
+        if not self._authorized(request):
+            return web.json_response({"message": "Unauthorized"}, status=401)
+        if request.method == "GET":
+            return await self._handle_websocket(request)
+        return await self._handle_stream(request)
+
+    async def _handle_websocket(self, request):
+        ws = web.WebSocketResponse(heartbeat=self.stale_after)
+        await ws.prepare(request)
+        self._open()
+        print(f"座標の受け取りを開始しました (WebSocket, {request.remote})")
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.TEXT:
+                    self.receive(message.data)
+                elif message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self._close()
+            print(f"座標の受け取りを終了しました (WebSocket, {request.remote})")
+        return ws
+
+    async def _handle_stream(self, request):
+        self._open()
+        print(f"座標の受け取りを開始しました (HTTP, {request.remote})")
+        applied = 0
+        try:
+            async for line in request.content:
+                line = line.strip()
+                if line:
+                    applied += self.receive(line)
+                else:
+                    self.last_received = time.monotonic()  # 空行はハートビートとして扱う
+        finally:
+            self._close()
+            print(f"座標の受け取りを終了しました (HTTP, {request.remote})")
+        return web.json_response({"updates": applied})
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+from aiohttp import web
+
+DEFAULT_SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FANOUT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_SECONDS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            yield bound, total
+
+
+class RateMeter:
+    """直近 window 秒間の 1 秒あたりの回数を求めます。"""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.seconds = deque()  # [(秒, 回数), ...]
+
+    def add(self, value=1):
+        now = int(time.monotonic())
+        if self.seconds and self.seconds[-1][0] == now:
+            self.seconds[-1][1] += value
+        else:
+            self.seconds.append([now, value])
+        self._trim(now)
+
+    def _trim(self, now):
+        while self.seconds and self.seconds[0][0] <= now - self.window:
+            self.seconds.popleft()
+
+    def rate(self):
+        self._trim(int(time.monotonic()))
+        return sum(count for _, count in self.seconds) / self.window
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """
+    サーバー内部の計測値を集め、/metrics で Prometheus のテキスト形式 (または JSON) で返します。
+    gauge には呼び出すたびに現在値を返す関数を登録します。
+    counter_from には、他のモジュールが数えている増えるだけの合計を返す関数を登録します (counter として出す)。
+    """
+
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> 値
+        self.rates = {}  # (name, labels) -> RateMeter
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}  # name -> 現在値を返す関数 (数値、または {ラベル値: 数値})
+        self.counter_reads = {}  # name -> 増えるだけの合計を返す関数
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, rate=False, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        if rate:
+            meter = self.rates.get(key)
+            if meter is None:
+                meter = self.rates[key] = RateMeter()
+            meter.add(value)
+
+    def histogram(self, name, buckets=DEFAULT_SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        return histogram
+
+    def observe(self, name, value, buckets=DEFAULT_SECONDS_BUCKETS, **labels):
+        self.histogram(name, buckets, **labels).observe(value)
+
+    def gauge(self, name, read, label=None):
+        self.gauges[name] = (read, label)
+
+    def counter_from(self, name, read):
+        self.counter_reads[name] = read
+
+    def _counter_values(self):
+        for (name, labels), value in self.counters.items():
+            yield name, dict(labels), value
+        for name, read in self.counter_reads.items():
+            yield name, {}, read()
+
+    def _gauge_values(self):
+        for name, (read, label) in self.gauges.items():
+            value = read()
+            if isinstance(value, dict):
+                for label_value, item in value.items():
+                    yield name, {label: label_value}, item
+            else:
+                yield name, {}, value
+
+    def render(self):
+        lines = []
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, labels, value in sorted(self._counter_values(), key=lambda item: (item[0], sorted(item[1].items()))):
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), meter in sorted(self.rates.items()):
+            rate_name = name.removesuffix("_total") + "_per_second"
+            header(rate_name, "gauge")
+            lines.append(f"{rate_name}{_labels(dict(labels))} {meter.rate():.3f}")
+        for name, labels, value in self._gauge_values():
+            header(name, "gauge")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            labels = dict(labels)
+            for bound, total in histogram.cumulative():
+                le = "+Inf" if bound == math.inf else f"{bound:g}"
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {total}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        def key_name(name, labels):
+            return name + _labels(dict(labels))
+
+        return {
+            "counters": {key_name(name, labels.items()): value for name, labels, value in self._counter_values()},
+            "rates": {key_name(*key): round(meter.rate(), 3) for key, meter in self.rates.items()},
+            "gauges": {key_name(name, labels.items()): value for name, labels, value in self._gauge_values()},
+            "histograms": {
+                key_name(*key): {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": {("+Inf" if bound == math.inf else f"{bound:g}"): total
+                                for bound, total in histogram.cumulative()},
+                }
+                for key, histogram in self.histograms.items()
+            },
+        }
+
+    async def handle(self, request):
+        if request.query.get("format") == "json":
+            return web.json_response(self.snapshot())
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+
+    async def monitor_event_loop(self, interval=0.5):
+        """interval 秒ごとに起きて、予定より何秒遅れて起きたかをイベントループの遅延として記録します。"""
+        lag = self.histogram("vc_event_loop_lag_seconds")
+        self.last_event_loop_lag = 0.0
+        self.gauge("vc_event_loop_lag_last_seconds", lambda: self.last_event_loop_lag)
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.last_event_loop_lag = max(0.0, time.perf_counter() - started - interval)
+            lag.observe(self.last_event_loop_lag)
+
+
+class SampledLogger:
+    """
+    毎フレーム出るようなログを、同じ key ごとに every 回に 1 回だけ出します。
+    ログレベルが無効なときは回数も数えないので、ホットパスでもほとんど負荷になりません。
+    """
+
+    def __init__(self, logger, every=100):
+        self.logger = logger
+        self.every = every
+        self.counts = {}
+
+    def log(self, level, key, message, *args):
+        if not self.logger.isEnabledFor(level):
+            return
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count % self.every == 0:
+            if count:
+                message += f" (同じログ {self.every} 件のうち1件を表示)"
+            self.logger.log(level, message, *args)
+
+    def debug(self, key, message, *args):
+        self.log(logging.DEBUG, key, message, *args)
+
+    def warning(self, key, message, *args):
+        self.log(logging.WARNING, key, message, *args)
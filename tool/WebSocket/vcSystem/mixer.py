@@ -0,0 +1,76 @@
+import asyncio
+
+import numpy as np
+
+from audio_codec import decode_frames, encode_audio
+
+
+def mix_and_encode(sources, bitrate, container_format):
+    """(pcm, gain) のリストを音量を掛けて足し合わせ、1 本の音声にエンコードします。"""
+    length = max(len(pcm) for pcm, _ in sources)
+    mixed = np.zeros(length, dtype=np.float32)
+    for pcm, gain in sources:
+        mixed[:len(pcm)] += pcm * gain
+    np.clip(mixed, -1.0, 1.0, out=mixed)
+    return encode_audio(mixed, bitrate, container_format)
+
+
+class AudioMixer:
+    """
+    話者ごとに受け取った音声を溜めておき、mix() のたびに受信者ごとの音量で足し合わせて
+    受信者 1 人につき 1 本の音声にエンコードします。デコードとエンコードは executor 上で行います。
+    聞こえる話者と音量がまったく同じ受信者どうしは、1 本のミックスを共有します。
+    """
+
+    def __init__(self, executor, bitrate=64000, container_format="webm"):
+        self.executor = executor
+        self.bitrate = bitrate
+        self.container_format = container_format
+        self.frames = {}  # speaker -> [音声データ, ...]
+        self.stats = {"mixes": 0, "listeners": 0}
+
+    def push(self, speaker, data):
+        self.frames.setdefault(speaker, []).append(data)
+
+    async def mix(self, plan_mix):
+        """
+        溜まっている音声をミックスし、{listener: エンコード済みの音声} を返します。
+        plan_mix(speakers) は {listener: [(speaker, gain), ...]} を返す関数です。
+        """
+        frames, self.frames = self.frames, {}
+        if not frames:
+            return {}
+
+        loop = asyncio.get_running_loop()
+        speakers = list(frames)
+        decoded = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, decode_frames, frames[speaker]) for speaker in speakers
+        ))
+        pcm_by_speaker = {speaker: pcm for speaker, pcm in zip(speakers, decoded) if pcm is not None}
+        if not pcm_by_speaker:
+            return {}
+
+        # 同じ話者の組み合わせを同じ音量で聞く受信者には、同じミックスを1回だけ作って送る
+        groups = {}  # ((speaker, gain), ...) -> [listener, ...]
+        for listener, sources in plan_mix(pcm_by_speaker.keys()).items():
+            key = tuple(sorted((speaker, gain) for speaker, gain in sources if gain > 0))
+            if key:
+                groups.setdefault(key, []).append(listener)
+        encoded = await asyncio.gather(*(
+            loop.run_in_executor(
+                self.executor, mix_and_encode,
+                [(pcm_by_speaker[speaker], gain) for speaker, gain in key], self.bitrate, self.container_format,
+            )
+            for key in groups
+        ), return_exceptions=True)
+        self.stats["mixes"] += len(groups)
+        self.stats["listeners"] += sum(len(listeners) for listeners in groups.values())
+
+        mixes = {}
+        for listeners, data in zip(groups.values(), encoded):
+            if isinstance(data, Exception):
+                print(f"Error mixing audio for {', '.join(listeners)}: {data}")
+                continue
+            for listener in listeners:
+                mixes[listener] = data
+        return mixes
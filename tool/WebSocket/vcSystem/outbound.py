@@ -0,0 +1,84 @@
+import asyncio
+import logging
+from collections import deque
+
+import websockets
+
+from metrics import SampledLogger
+
+sampled_log = SampledLogger(logging.getLogger("vcSystem"))
+
+
+class OutboundQueue:
+    """
+    接続ごとの送信キューです。送信は接続ごとのタスクで行うので、遅いクライアントが他の受信者を待たせません。
+    音声フレームは上限を超えたら古いものから捨て、制御メッセージ (名前の対応表や初期化セグメント) は捨てずに先に送ります。
+    userList は前のものを置き換えるので、送れていないものは最新の1つだけを持ちます。
+    """
+
+    dropped_frames_total = 0  # 全接続で捨てた音声フレーム数
+    replaced_user_lists_total = 0  # 全接続で、送る前に新しいものに置き換えた userList の数
+
+    def __init__(self, websocket, max_audio_frames=8):
+        self.websocket = websocket
+        self.control = deque()
+        self.user_list = None  # まだ送っていない最新の userList
+        self.audio = deque(maxlen=max_audio_frames)
+        self.dropped_frames = 0
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.control) + (self.user_list is not None) + len(self.audio)
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, message):
+        self.control.append(message)
+        self.wakeup.set()
+
+    def send_user_list(self, message):
+        if self.user_list is not None:
+            OutboundQueue.replaced_user_lists_total += 1
+        self.user_list = message
+        self.wakeup.set()
+
+    def send_audio(self, message):
+        if len(self.audio) == self.audio.maxlen:
+            self.dropped_frames += 1
+            OutboundQueue.dropped_frames_total += 1
+        self.audio.append(message)  # maxlen を超えた分は先頭 (最も古いフレーム) が捨てられる
+        self.wakeup.set()
+
+    async def _run(self):
+        username = getattr(self.websocket, "username", None)
+        while True:
+            if not self.control and self.user_list is None and not self.audio:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if self.control:
+                message = self.control.popleft()
+            elif self.user_list is not None:
+                # 名前の対応表 (control) を送り切ってから userList を送る
+                message, self.user_list = self.user_list, None
+            else:
+                message = self.audio.popleft()
+            try:
+                await self.websocket.send(message)
+            except websockets.exceptions.ConnectionClosed:
+                break
+            except Exception as e:
+                sampled_log.warning("send-error", "Error sending data to %s: %s", username, e)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.control.clear()
+        self.user_list = None
+        self.audio.clear()
@@ -0,0 +1,80 @@
+import numpy as np
+
+from spatial import SpatialGrid
+
+
+class PositionStore:
+    """
+    座標を NumPy の連続配列で保持し、近くのユーザーとの距離と音量を配列でまとめて計算します。
+    計算する相手は SpatialGrid のセルで周りにいるユーザーだけに絞るので、
+    nearby() の手間は全体の人数ではなく周りの人数に比例し、update() は座標を書き換えるだけです。
+    """
+
+    def __init__(self, radius=30, volume_fn=None, capacity=64):
+        self.radius = radius
+        self.volume_fn = volume_fn  # 距離の配列を受け取り音量の配列を返す関数
+        self.grid = SpatialGrid(radius)  # 候補の絞り込みに使う (セルの一辺は可聴距離)
+        self.rows = {}  # username -> 行番号
+        self.usernames = []  # 行番号 -> username
+        self.points = np.zeros((capacity, 3))
+
+    def _grow(self):
+        points = self.points
+        self.points = np.zeros((max(1, len(points) * 2), 3))
+        self.points[:len(points)] = points
+
+    def __contains__(self, username):
+        return username in self.rows
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def _gain(self, distances):
+        if self.volume_fn is None:
+            return np.where(distances <= self.radius, 1.0, 0.0)
+        return self.volume_fn(distances)
+
+    def update(self, username, position, dimension=0):
+        # 先にグリッドを更新する (座標がおかしくて例外になっても配列と食い違わないように)
+        self.grid.update(username, position, dimension)
+        row = self.rows.get(username)
+        if row is None:
+            if len(self.usernames) == len(self.points):
+                self._grow()
+            row = len(self.usernames)
+            self.rows[username] = row
+            self.usernames.append(username)
+        self.points[row] = (position["x"], position["y"], position["z"])
+
+    def remove(self, username):
+        row = self.rows.pop(username, None)
+        if row is None:
+            return
+        self.grid.remove(username)
+        last = len(self.usernames) - 1
+        moved = self.usernames.pop()
+        if row != last:
+            # 最後の行を空いた行へ移して配列を詰める
+            self.usernames[row] = moved
+            self.rows[moved] = row
+            self.points[row] = self.points[last]
+
+    def nearby(self, username, radius=None):
+        """username から radius 以内にいるユーザーを (username, distance, volume) のリストで返します。"""
+        row = self.rows.get(username)
+        if row is None:
+            return []
+        if radius is None:
+            radius = self.radius
+        candidates = self.grid.candidates(username, radius)
+        if not candidates:
+            return []
+        rows = np.fromiter((self.rows[other] for other in candidates), dtype=np.intp, count=len(candidates))
+        distances = np.sqrt(((self.points[rows] - self.points[row]) ** 2).sum(axis=1))
+        columns = np.flatnonzero(distances <= radius)
+        distances = distances[columns]
+        gains = self._gain(distances)
+        return [
+            (candidates[column], float(distance), float(gain))
+            for column, distance, gain in zip(columns, distances, gains)
+        ]
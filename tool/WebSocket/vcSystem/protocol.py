@@ -0,0 +1,102 @@
+import math
+import struct
+
+# "vc.bin.v1" サブプロトコルの制御メッセージ
+# 先頭1バイトがメッセージの種類。音声 (WebM の 0x1A / Ogg の "O" / VC ヘッダーの "V") と
+# 区別できるよう、種類は 0x01-0x0F の範囲に置く。数値はすべてリトルエンディアン
+BINARY_SUBPROTOCOL = "vc.bin.v1"
+
+MSG_SET_POSITION = 0x01  # クライアント -> サーバー: x, y, z (float32) / dimension (int16)
+MSG_USER_LIST = 0x02  # サーバー -> クライアント: 件数 (uint16)、続けて ID (uint16) / 距離 / 音量 (float32)
+MSG_USER_NAMES = 0x03  # サーバー -> クライアント: 件数 (uint16)、続けて ID (uint16) / 名前の長さ (uint8) / 名前 (UTF-8)
+# クライアント -> サーバー: 続けて録音中の WebM の続き。チャンクの先頭は任意のバイトになるので、この1バイトを付けて送る
+MSG_AUDIO_CHUNK = 0x04
+
+SET_POSITION = struct.Struct("<B3fh")
+LIST_HEADER = struct.Struct("<BH")
+USER_ENTRY = struct.Struct("<Hff")
+NAME_ENTRY = struct.Struct("<HB")
+DIMENSION_UNKNOWN = -32768  # dimension を送らない場合の値
+# 受け付ける dimension の範囲 (int16 から DIMENSION_UNKNOWN を除いたもの)。共有メモリの表や記録ファイルにもこの範囲で書く
+DIMENSION_MIN = -32767
+DIMENSION_MAX = 32767
+MAX_COORDINATE = 30_000_000.0  # ワールドの端より外の座標は受け付けない (float32 に収まる範囲にしておく)
+
+
+def is_control_message(data):
+    return len(data) > 0 and 0x01 <= data[0] <= 0x0F
+
+
+def is_audio_chunk(data):
+    return len(data) > 0 and data[0] == MSG_AUDIO_CHUNK
+
+
+def is_valid_position(position):
+    """
+    {"x", "y", "z"} がすべて ±MAX_COORDINATE 以内の有限の数値なら True を返します
+    (JSON の NaN / Infinity や、float32 に収まらない値は受け付けない)。
+    """
+    if not isinstance(position, dict):
+        return False
+    for axis in ("x", "y", "z"):
+        value = position.get(axis)
+        if not isinstance(value, (int, float)) or not math.isfinite(value) or abs(value) > MAX_COORDINATE:
+            return False
+    return True
+
+
+def parse_dimension(value):
+    """value が受け付けられる dimension (範囲内の整数) ならそのまま、そうでなければ None を返します。"""
+    if isinstance(value, int) and not isinstance(value, bool) and DIMENSION_MIN <= value <= DIMENSION_MAX:
+        return value
+    return None
+
+
+def pack_position(position, dimension=None):
+    return SET_POSITION.pack(
+        MSG_SET_POSITION, position["x"], position["y"], position["z"],
+        DIMENSION_UNKNOWN if dimension is None else dimension,
+    )
+
+
+def unpack_position(data):
+    """setPosition を (position, dimension) で返します。形式が合わないか座標が範囲外なら None です。"""
+    if len(data) != SET_POSITION.size or data[0] != MSG_SET_POSITION:
+        return None
+    _, x, y, z, dimension = SET_POSITION.unpack(data)
+    position = {"x": x, "y": y, "z": z}
+    if not is_valid_position(position):
+        return None
+    return position, None if dimension == DIMENSION_UNKNOWN else dimension
+
+
+def pack_user_list(users):
+    """users は get_nearby_users が返す dict のリスト。音量が無い場合は NaN を入れます。"""
+    parts = [LIST_HEADER.pack(MSG_USER_LIST, len(users))]
+    for user in users:
+        parts.append(USER_ENTRY.pack(user["id"], user["distance"], user.get("volume", math.nan)))
+    return b"".join(parts)
+
+
+def pack_user_names(names):
+    """names は (ID, ユーザー名) のリスト。"""
+    parts = [LIST_HEADER.pack(MSG_USER_NAMES, len(names))]
+    for session_id, username in names:
+        encoded = username.encode()[:255]
+        parts.append(NAME_ENTRY.pack(session_id, len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+def user_list_messages(users, sent_names):
+    """
+    userList を送るためのメッセージのリストを返します。
+    sent_names (ID -> その接続に伝えたユーザー名) に無い ID があれば、先に名前の対応表を送ります。
+    """
+    names = [(user["id"], user["username"]) for user in users if sent_names.get(user["id"]) != user["username"]]
+    messages = []
+    if names:
+        sent_names.update(names)
+        messages.append(pack_user_names(names))
+    messages.append(pack_user_list(users))
+    return messages
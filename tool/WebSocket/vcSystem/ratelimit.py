@@ -0,0 +1,45 @@
+import time
+
+
+class TokenBucket:
+    """rate 個/秒で貯まり、burst 個まで溜めておけるトークンバケットです。"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, cost=1.0, now=None):
+        """トークンを cost 個使えれば使って True を返します。足りなければ使わずに False を返します。"""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class ConnectionLimiter:
+    """
+    接続1つ分の、メッセージの種類ごとのトークンバケットです。
+    制限を超えたメッセージは捨てるだけですが、超えたメッセージ自体も violations のバケットで数え、
+    それも使い切るほど送り続ける接続は exceeded を True にして、呼び出し側に切断してもらいます。
+    """
+
+    def __init__(self, limits, violations=(1.0, 50)):
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in limits.items()}
+        self.violations = TokenBucket(*violations)
+        self.exceeded = False
+        self.throttled = 0
+
+    def allow(self, kind, now=None):
+        """kind のメッセージを処理してよければ True を返します。制限の無い種類は常に True です。"""
+        bucket = self.buckets.get(kind)
+        if bucket is None or bucket.take(now=now):
+            return True
+        self.throttled += 1
+        if not self.violations.take(now=now):
+            self.exceeded = True
+        return False
@@ -0,0 +1,152 @@
+import collections
+import struct
+import time
+
+# 記録ファイルの形式 (数値はすべてリトルエンディアン)
+#   ファイルの先頭に FILE_MAGIC、続けてレコードを追記していく
+#   レコード: 経過秒数 (float64, セッションの開始から) / 種類 (uint8) / 本体の長さ (uint32)、続けて本体
+#   本体: ユーザー名の長さ (uint8) / ユーザー名 (UTF-8)、続けて種類ごとの固定長部分、音声ならその後ろに中身
+# サーバーを起動するたびに REC_SESSION から始まる新しいセッションが追記される
+FILE_MAGIC = b"VCREC\x01"
+RECORD = struct.Struct("<dBI")
+
+REC_SESSION = 0  # セッションの開始: 開始時刻 (UNIX 時間, float64)
+REC_CONNECT = 1  # 接続: vc.bin.v1 か (uint8)
+REC_DISCONNECT = 2  # 切断
+REC_POSITION = 3  # 座標: 取得元 (uint8) / x, y, z (float32) / dimension (int16)
+REC_AUDIO = 4  # 音声: 受け取ったバイト数 (uint32) / 中身を記録したか (uint8)、続けて中身
+
+SESSION = struct.Struct("<d")
+CONNECT = struct.Struct("<B")
+POSITION = struct.Struct("<B3fh")
+AUDIO = struct.Struct("<IB")
+DIMENSION_UNKNOWN = -32768
+
+SOURCE_CLIENT = 0  # クライアントの setPosition
+SOURCE_POLL = 1  # API サーバーへのポーリング
+SOURCE_INGEST = 2  # /ingest
+
+Record = collections.namedtuple("Record", "time kind username values payload")
+
+
+class SessionRecorder:
+    """
+    接続・切断・座標の更新・音声フレームを、経過時間付きで追記専用のファイルに書きます。
+    bench/replay.py で同じタイミングのまま (または速めて) サーバーに流し直せます。
+    音声は payloads が True のときだけ中身も書き、False なら大きさだけを書きます。
+    ファイルへはバッファ越しに書き、flush_interval 秒ごとにまとめて書き出します。
+    """
+
+    def __init__(self, path, payloads=False, max_bytes=None, flush_interval=1.0):
+        self.path = path
+        self.payloads = payloads
+        self.max_bytes = max_bytes  # これを超えたら以降のレコードは捨てる
+        self.flush_interval = flush_interval
+        self.file = open(path, "ab", buffering=64 * 1024)
+        if self.file.tell() == 0:
+            self.file.write(FILE_MAGIC)
+        self.started = time.monotonic()
+        self.flushed_at = self.started
+        self.stats = {"records": 0, "bytes": 0, "dropped": 0, "invalid": 0, "errors": 0}
+        self._write(REC_SESSION, "", SESSION.pack(time.time()))
+
+    def connect(self, username, binary_protocol):
+        self._write(REC_CONNECT, username, CONNECT.pack(binary_protocol))
+
+    def disconnect(self, username):
+        self._write(REC_DISCONNECT, username, b"")
+
+    def position(self, username, position, dimension, source):
+        try:
+            body = POSITION.pack(
+                source, position["x"], position["y"], position["z"],
+                DIMENSION_UNKNOWN if dimension is None else dimension,
+            )
+        except (struct.error, OverflowError):
+            # 記録に失敗しても中継は止めない (値は受け取った側で範囲を確かめているので、ここには来ないはず)
+            self.stats["invalid"] += 1
+            return
+        self._write(REC_POSITION, username, body)
+
+    def audio(self, username, data):
+        payload = data if self.payloads else b""
+        self._write(REC_AUDIO, username, AUDIO.pack(len(data), self.payloads), payload)
+
+    def _write(self, kind, username, body, payload=b""):
+        if self.file is None:
+            return
+        if self.max_bytes is not None and self.stats["bytes"] >= self.max_bytes:
+            self.stats["dropped"] += 1
+            return
+        now = time.monotonic()
+        name = username.encode()[:255]
+        size = 1 + len(name) + len(body) + len(payload)
+        try:
+            self.file.write(RECORD.pack(now - self.started, kind, size))
+            self.file.write(bytes((len(name),)))
+            self.file.write(name)
+            self.file.write(body)
+            if payload:
+                self.file.write(payload)
+            if now - self.flushed_at >= self.flush_interval:
+                self.file.flush()
+                self.flushed_at = now
+        except OSError as e:
+            # ディスクがいっぱいなどで書けなくなったら記録だけをやめ、中継は続ける
+            self.stats["errors"] += 1
+            print(f"{self.path} への記録を中止しました: {e}")
+            self._close_quietly()
+            return
+        self.stats["records"] += 1
+        self.stats["bytes"] += RECORD.size + size
+
+    def _close_quietly(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self._close_quietly()
+
+
+def read_records(path):
+    """記録ファイルのレコードを順に Record で返します。途中で切れているレコード (書き込み中に落ちた分) は無視します。"""
+    bodies = {
+        REC_SESSION: SESSION,
+        REC_CONNECT: CONNECT,
+        REC_POSITION: POSITION,
+        REC_AUDIO: AUDIO,
+    }
+    with open(path, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f"{path} is not a vcSystem recording")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            elapsed, kind, size = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            name_length = data[0]
+            username = data[1:1 + name_length].decode()
+            offset = 1 + name_length
+            body = bodies.get(kind)
+            values = ()
+            if body is not None:
+                values = body.unpack_from(data, offset)
+                offset += body.size
+            yield Record(elapsed, kind, username, values, data[offset:])
+
+
+def read_sessions(path):
+    """記録ファイルをセッションごとに分けて、Record のリストのリストで返します。"""
+    sessions = []
+    for record in read_records(path):
+        if record.kind == REC_SESSION or not sessions:
+            sessions.append([])
+        sessions[-1].append(record)
+    return sessions
@@ -0,0 +1,115 @@
+import asyncio
+import math
+import time
+
+
+class Ticker:
+    """
+    interval 秒ごとに起きるタイマーです。次に起きる時刻を前回の予定時刻から数えるので、
+    ループ内の処理に時間がかかっても周期がずれていきません。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.deadline = None
+
+    async def wait(self):
+        """次の予定時刻まで待ち、予定に間に合わなかった場合は遅れた秒数を返します。"""
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.interval
+        delay = self.deadline - now
+        if delay < 0:
+            # 間に合わなかった分は取り戻そうとせず、ここから数え直す
+            self.deadline = now
+            return -delay
+        await asyncio.sleep(delay)
+        return 0.0
+
+
+class MotionTracker:
+    """
+    ユーザーごとの最後の座標と速度を覚えておき、
+    速く動いているユーザーほど短い間隔で座標を問い合わせるように予定を立て、
+    問い合わせの合間の座標を速度から推定 (デッドレコニング) します。
+    """
+
+    def __init__(self, min_interval=0.25, max_interval=5.0, step=2.0, horizon=1.0,
+                 max_speed=50.0, smoothing=0.5, min_move=0.1):
+        self.min_interval = min_interval  # 最も速いユーザーの問い合わせ間隔 (秒)
+        self.max_interval = max_interval  # 止まっているユーザーの問い合わせ間隔 (秒)
+        self.step = step  # 問い合わせの間に動いてよい距離 (ブロック)
+        self.horizon = horizon  # 最後の座標からこの秒数より先は推定しない
+        self.max_speed = max_speed  # これより速い移動はテレポートとみなして速度を 0 にする (ブロック/秒)
+        self.smoothing = smoothing  # 新しく測った速度の重み (0-1)
+        self.min_move = min_move  # 推定した座標がこれ以上動いたときだけ返す (ブロック)
+        self.samples = {}  # username -> [時刻, (x, y, z), dimension, (vx, vy, vz), 最後に返した座標]
+        self.next_poll = {}  # username -> 次に問い合わせる時刻
+
+    def forget(self, username):
+        self.samples.pop(username, None)
+        self.next_poll.pop(username, None)
+
+    def record(self, username, position, dimension, now=None):
+        now = time.monotonic() if now is None else now
+        point = (position["x"], position["y"], position["z"])
+        sample = self.samples.get(username)
+        velocity = (0.0, 0.0, 0.0)
+        if sample is not None and sample[2] == dimension:
+            elapsed = now - sample[0]
+            if elapsed <= 0:
+                velocity = sample[3]
+            elif point != sample[1]:
+                measured = tuple((new - old) / elapsed for new, old in zip(point, sample[1]))
+                if math.hypot(*measured) <= self.max_speed:
+                    velocity = tuple(
+                        self.smoothing * new + (1 - self.smoothing) * old
+                        for new, old in zip(measured, sample[3])
+                    )
+        self.samples[username] = [now, point, dimension, velocity, point]
+        self.next_poll[username] = now + self.interval_for(velocity)
+
+    def interval_for(self, velocity):
+        speed = math.hypot(*velocity)
+        if speed <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, self.step / speed))
+
+    def defer(self, username, delay, now=None):
+        """座標を取得できなかったユーザーの次の問い合わせを delay 秒後にします。"""
+        self.next_poll[username] = (time.monotonic() if now is None else now) + delay
+
+    def due(self, username, now=None):
+        """一度も問い合わせていないか、次に問い合わせる時刻を過ぎていれば True を返します。"""
+        return (time.monotonic() if now is None else now) >= self.next_poll.get(username, 0.0)
+
+    def settle(self, username):
+        """
+        推定をやめて速度を 0 にします。推定した座標を返していた場合は、最後に記録した座標を返します (それ以外は None)。
+        動いたときだけ座標が届くユーザーは止まったことが分からないので、推定を続けると座標がずれたままになります。
+        """
+        sample = self.samples.get(username)
+        if sample is None:
+            return None
+        sample[3] = (0.0, 0.0, 0.0)
+        if sample[4] == sample[1]:
+            return None
+        sample[4] = sample[1]
+        return {"x": sample[1][0], "y": sample[1][1], "z": sample[1][2]}
+
+    def extrapolate(self, username, now=None):
+        """
+        速度から推定した現在の座標を返します。
+        止まっているユーザー、記録の無いユーザー、前回返した座標から min_move 以上動いていない場合は None です。
+        """
+        sample = self.samples.get(username)
+        if sample is None or sample[3] == (0.0, 0.0, 0.0):
+            return None
+        now = time.monotonic() if now is None else now
+        elapsed = min(now - sample[0], self.horizon)
+        point = tuple(p + v * elapsed for p, v in zip(sample[1], sample[3]))
+        if math.dist(point, sample[4]) < self.min_move:
+            return None
+        sample[4] = point
+        return {"x": point[0], "y": point[1], "z": point[2]}
@@ -0,0 +1,83 @@
+import math
+
+
+class SpatialGrid:
+    """
+    ディメンションごとに分割した一様グリッドで近接ユーザーを検索します。
+    セルの一辺を可聴距離と同じにしておくと、検索は周囲 27 セルだけで済みます。
+    """
+
+    def __init__(self, cell_size=30, volume_fn=None):
+        self.cell_size = cell_size
+        self.volume_fn = volume_fn  # 距離を受け取り音量を返す関数
+        self.cells = {}  # (dimension, cx, cy, cz) -> {username, ...}
+        self.entries = {}  # username -> (cell_key, (x, y, z))
+
+    def _cell_key(self, dimension, x, y, z):
+        size = self.cell_size
+        return (dimension, math.floor(x / size), math.floor(y / size), math.floor(z / size))
+
+    def __contains__(self, username):
+        return username in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, username, position, dimension=0):
+        point = (position["x"], position["y"], position["z"])
+        key = self._cell_key(dimension, *point)
+        entry = self.entries.get(username)
+        if entry and entry[0] != key:
+            self._discard(username, entry[0])
+        if not entry or entry[0] != key:
+            self.cells.setdefault(key, set()).add(username)
+        self.entries[username] = (key, point)
+
+    def remove(self, username):
+        entry = self.entries.pop(username, None)
+        if entry:
+            self._discard(username, entry[0])
+
+    def _discard(self, username, key):
+        cell = self.cells.get(key)
+        if cell is None:
+            return
+        cell.discard(username)
+        if not cell:
+            del self.cells[key]
+
+    def candidates(self, username, radius=None):
+        """username の周りのセルにいるユーザー (radius より遠い人も含む、本人は除く) をリストで返します。"""
+        entry = self.entries.get(username)
+        if not entry:
+            return []
+        if radius is None:
+            radius = self.cell_size
+
+        dimension, cx, cy, cz = entry[0]
+        reach = max(1, math.ceil(radius / self.cell_size))
+        result = []
+        for dx in range(-reach, reach + 1):
+            for dy in range(-reach, reach + 1):
+                for dz in range(-reach, reach + 1):
+                    cell = self.cells.get((dimension, cx + dx, cy + dy, cz + dz))
+                    if cell:
+                        result.extend(other for other in cell if other != username)
+        return result
+
+    def nearby(self, username, radius=None):
+        """username から radius 以内にいるユーザーを (username, distance, volume) のリストで返します。"""
+        entry = self.entries.get(username)
+        if not entry:
+            return []
+        if radius is None:
+            radius = self.cell_size
+
+        point = entry[1]
+        result = []
+        for other in self.candidates(username, radius):
+            distance = math.dist(point, self.entries[other][1])
+            if distance <= radius:
+                volume = self.volume_fn(distance) if self.volume_fn else 1.0
+                result.append((other, distance, volume))
+        return result
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+logger = logging.getLogger("vcSystem")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    連続で失敗したら一定時間リクエストを止め、その後 1 件だけ試して復帰を判断します。
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Upstream circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("Upstream circuit opened after %d failures", self.failures)
+            self.opened_at = time.monotonic()
+
+
+class UpstreamClient:
+    """
+    API サーバーへの HTTP リクエストを 1 つの ClientSession で使い回すクライアントです。
+    コネクションプールと keep-alive、リクエストごとのタイムアウト、サーキットブレーカーを持ちます。
+    """
+
+    def __init__(self, base_url, max_connections=32, timeout=3.0, keepalive_timeout=30.0,
+                 failure_threshold=5, reset_timeout=10.0, max_pending=None, latency_histogram=None):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.max_pending = max_pending if max_pending is not None else max_connections * 4
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.latency_histogram = latency_histogram  # observe(秒) を持つオブジェクト (metrics.Histogram など)
+        self.session = None
+        self.pending = 0
+        self.stats = {
+            "requests": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "rejected": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[trace_config],
+            )
+        return self.session
+
+    async def _on_connection_created(self, session, context, params):
+        self.stats["connections_created"] += 1
+
+    async def _on_connection_reused(self, session, context, params):
+        self.stats["connections_reused"] += 1
+
+    async def get_json(self, endpoint, headers=None):
+        url = f"{self.base_url}/{endpoint}"
+        if self.pending >= self.max_pending or not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise CircuitOpenError(f"Upstream unavailable, skipped {url}")
+
+        self.pending += 1
+        self.stats["requests"] += 1
+        started = time.perf_counter()
+        try:
+            async with self._get_session().get(url, headers=headers) as response:
+                if response.status != 200:
+                    try:
+                        error_data = await response.json()
+                    except Exception:
+                        error_data = {"error": "Failed to parse error response."}
+                    raise Exception(f"HTTP error {response.status} fetching {url}: {json.dumps(error_data)}")
+                data = await response.json()
+        except asyncio.CancelledError:
+            self.breaker.trial_in_flight = False
+            raise
+        except Exception as error:
+            if isinstance(error, asyncio.TimeoutError):
+                self.stats["timeouts"] += 1
+            self.stats["failures"] += 1
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.pending -= 1
+            latency = time.perf_counter() - started
+            self.stats["latency_total"] += latency
+            self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+            if self.latency_histogram is not None:
+                self.latency_histogram.observe(latency)
+
+        self.breaker.record_success()
+        return data
+
+    def snapshot(self):
+        completed = self.stats["requests"]
+        return {
+            **self.stats,
+            "latency_avg": self.stats["latency_total"] / completed if completed else 0.0,
+            "pending": self.pending,
+            "circuit": self.breaker.state,
+        }
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
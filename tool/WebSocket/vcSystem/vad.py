@@ -0,0 +1,167 @@
+import asyncio
+import math
+
+try:
+    import audio_codec
+except ImportError:  # numpy が無い場合は energy モードを使えない
+    audio_codec = None
+
+from container import CLUSTER_ID, EBML_MAGIC, OGG_MAGIC, ogg_header_length
+
+CLUSTER_MAGIC = CLUSTER_ID.to_bytes(4, "big")
+
+MODE_OFF = "off"  # すべて中継する
+MODE_SIZE = "size"  # チャンクの大きさで判定する (デコードしない)
+MODE_ENERGY = "energy"  # デコードして音量で判定する (executor で実行する)
+MODES = (MODE_OFF, MODE_SIZE, MODE_ENERGY)
+
+FRAME_SAMPLES = 960  # 20ms (48kHz)
+
+
+def energy_available():
+    return audio_codec is not None and audio_codec.available
+
+
+def has_container_header(data):
+    """WebM / Ogg の先頭 (デコードに必要なヘッダー) を含むチャンクなら True を返します。"""
+    return data[:4] == EBML_MAGIC or data[:4] == OGG_MAGIC and b"OpusHead" in data[:64]
+
+
+def media_size(data, parsed=None):
+    """チャンクのうち、ヘッダーを除いた音声の部分のバイト数を返します。"""
+    if parsed is not None:
+        return len(parsed.media)
+    if data[:4] == OGG_MAGIC:
+        return len(data) - (ogg_header_length(data) or 0)
+    if data[:4] == EBML_MAGIC:
+        # 解析できなかった WebM は、最初のクラスターより前をヘッダーとみなす
+        cluster = data.find(CLUSTER_MAGIC)
+        if cluster >= 0:
+            return len(data) - cluster
+    return len(data)
+
+
+class SpeakerState:
+    def __init__(self):
+        self.noise_floor = None  # 無音のときのチャンクの大きさ (バイト)
+        self.peak = 0  # これまでで最も大きかったチャンクの大きさ (バイト)
+        self.hangover_left = 0  # 声が途切れてから、あと何チャンクは無音でも中継するか (ハングオーバー)
+        self.header = None  # energy モードでデコードに使う最初のチャンク
+        self.header_samples = 0  # header だけをデコードしたときのサンプル数
+
+
+class VoiceActivityGate:
+    """
+    話者ごとに、声が入っていないチャンクを受信者へ配る前に捨てます。
+    size モードでは Opus の可変ビットレートで無音のチャンクが小さくなることを使い、
+    話者ごとの無音時の大きさ (ノイズフロア) の size_ratio 倍を超えたチャンクを声とみなします。
+    energy モードではデコードした音声の RMS が energy_threshold (dBFS) を超えたチャンクを声とみなします。
+    声が途切れてからも hangover 個のチャンクは中継を続けるので、語尾が切れません。
+    クライアントはチャンクを一定の間隔 (500ms) でしか送らないので、ハングオーバーは秒ではなくチャンクの数で数えます。
+    pre_gated (クライアント側で無音を捨ててから送る) の話者のチャンクは声だけなので、size モードの判定とノイズフロアの学習をしません。
+    コンテナのヘッダーだけのチャンクは受信側のデコードに必要なので、常に中継します。
+    ヘッダーの後ろに音声が続くチャンクは、ヘッダーを除いた部分で判定します。
+    """
+
+    def __init__(self, hangover=2, size_ratio=1.5, energy_threshold=-45.0, floor_rise=0.02, executor=None):
+        self.hangover = hangover
+        self.size_ratio = size_ratio
+        self.energy_threshold = energy_threshold
+        self.floor_rise = floor_rise  # ノイズフロアを大きい方へ追従させる割合 (小さい方へはすぐ追従する)
+        self.executor = executor
+        self.speakers = {}  # username -> SpeakerState
+        self.stats = {"passed": 0, "dropped": 0, "hangover": 0}
+
+    def forget(self, username):
+        self.speakers.pop(username, None)
+
+    async def allow(self, username, data, mode=MODE_SIZE, parsed=None, pre_gated=False):
+        """
+        data を中継してよければ True を返します。
+        parsed (container.ParsedChunk) があれば、energy モードでは単独でデコードできる形にしたものを測ります。
+        """
+        if mode == MODE_OFF:
+            self.stats["passed"] += 1
+            return True
+        state = self.speakers.get(username)
+        if state is None:
+            state = self.speakers[username] = SpeakerState()
+
+        header = has_container_header(data)
+        if header:
+            state.header = data
+            state.header_samples = 0
+        # ヘッダーだけのチャンクは受信側のデコードに必要なので常に中継する。
+        # ヘッダー付きのチャンクも、判定はヘッダーを除いた音声の部分で行う
+        size = media_size(data, parsed)
+        if size == 0 and (header or parsed is not None):
+            self.stats["passed"] += 1
+            return True
+
+        if mode == MODE_ENERGY and energy_available() and parsed is not None:
+            active = await self._energy_active_parsed(parsed)
+        elif mode == MODE_ENERGY and energy_available() and header:
+            active = await self._energy_active_standalone(data)
+        elif mode == MODE_ENERGY and energy_available() and state.header is not None:
+            active = await self._energy_active(state, data)
+        elif pre_gated:
+            active = True
+        else:
+            active = self._size_active(state, size)
+
+        if active:
+            state.hangover_left = self.hangover
+            self.stats["passed"] += 1
+            return True
+        if state.hangover_left > 0:
+            state.hangover_left -= 1
+            self.stats["hangover"] += 1
+            return True
+        self.stats["dropped"] += 1
+        return False
+
+    def _size_active(self, state, size):
+        state.peak = max(state.peak, size)
+        if state.noise_floor is None or size < state.noise_floor:
+            state.noise_floor = size
+        # 声と無音の大きさの差をまだ見ていない間は、どれが無音か分からないので捨てない
+        if state.peak <= state.noise_floor * self.size_ratio:
+            return True
+        active = size > state.noise_floor * self.size_ratio
+        # 話している間はほとんど追従させない (長く話し続けても声が無音扱いにならないように)
+        rise = self.floor_rise / 20 if active else self.floor_rise
+        state.noise_floor += (size - state.noise_floor) * rise
+        return active
+
+    async def _energy_active(self, state, data):
+        loop = asyncio.get_running_loop()
+        if not state.header_samples:
+            header_pcm = await loop.run_in_executor(self.executor, audio_codec.decode_audio, state.header)
+            state.header_samples = 0 if header_pcm is None else len(header_pcm)
+        # ヘッダーのチャンクの後ろにつなげてデコードし、このチャンクの分だけで音量を測る
+        pcm = await loop.run_in_executor(self.executor, audio_codec.decode_audio, state.header + data)
+        if pcm is None or len(pcm) <= state.header_samples:
+            return True  # 判定できないものは捨てない
+        return self._frames_active(pcm[state.header_samples:])
+
+    async def _energy_active_parsed(self, parsed):
+        if not parsed.media:
+            return True
+        return await self._energy_active_standalone(parsed.standalone())
+
+    async def _energy_active_standalone(self, data):
+        loop = asyncio.get_running_loop()
+        pcm = await loop.run_in_executor(self.executor, audio_codec.decode_audio, data)
+        if pcm is None:
+            return True
+        return self._frames_active(pcm)
+
+    def _frames_active(self, chunk):
+        # 20ms ごとの音量の最大で判定する。先頭の1フレームはデコーダーの状態が前の音声とつながっていないので使わない
+        frames = chunk[:len(chunk) // FRAME_SAMPLES * FRAME_SAMPLES].reshape(-1, FRAME_SAMPLES)
+        if len(frames) > 1:
+            frames = frames[1:]
+        if len(frames) == 0:
+            return True
+        rms = math.sqrt(float((frames * frames).mean(axis=1).max()))
+        return rms > 0 and 20 * math.log10(rms) > self.energy_threshold